@@ -1,5 +1,6 @@
 from cmd import Cmd
 import numpy as np
+import re
 import sys
 import os.path
 
@@ -44,9 +45,10 @@ class Calculate(Cmd):
 
         self.input = inp
         self.outpath = outpath
-        self.data =  np.genfromtxt(self.input+".txt", dtype=float, comments="#")
+        self.parser = Parser(self.input+".txt")
+        self.data = self.parser.read()
         self.calc()
-        self.ndeltas = self.data[0]
+        self.ndeltas = self.parser.ndeltas
         if self.ndeltas>1:
             self.leaveone() 
                          
@@ -55,25 +57,19 @@ class Calculate(Cmd):
         """calculates the elastic constants from the input values of energy.\
         Uses the Script class which uses the least square method to find a solution to set of equations with 9 unknowns.\
         It creates a file with the constants and the residual, which is a good measure of reliability"""
-        self.ndeltas = self.data[0] # number of data sets (e.g. one data set for each value of strain)                   
-        self.volume = self.data[1] # volume of the crystal
-        self.eqenergy = self.data[2] # the zero stress energy
-        n=int(self.data[0])
-        # Rework the value of strain into needed form.
-        i = 0        
-        self.delt = [0.0]*n # here we collect the strain values into one array
-        for i in range (0, n):                 
-            self.delt[i] = self.data[i+3]
-                 
-        # Energies are prepared for the input format.    
-        self.values = [0.0]*((n)*28) #the list to which energies will be stored 
-        # pk4: here we change 12 to 28 as there are 14 deformation matrices and for each we have positive and negative stress        
-        # inports all the energy values and save them into self.values:      
-        for j in range(0, len(self.data) -3-n ):          
-            self.values[j] = self.data[j +3+n]
+        self.ndeltas = self.parser.ndeltas # number of data sets (e.g. one data set for each value of strain)                   
+        self.volume = self.parser.volume # volume of the crystal
+        self.eqenergy = self.parser.eqenergy # the zero stress energy
+        # The strains and energies (28 for each strain, 14 deformation matrices with positive and negative strain)
+        # are views into the parsed data, they are used directly as input.
+        self.delt = self.parser.deltas
+        self.values = self.parser.energies
         #print(" the energy values are %s", self.values)        
         a = Constants(self.ndeltas, self.volume, self.eqenergy,self.delt, self.values )        
         self.results, self.residual = a.solve()
+        self.note = a.note()
+        if self.note:
+            print(self.note)
         
         #Storing algorithm
         self.completeName = os.path.join(self.outpath, "Constants.txt")
@@ -88,8 +84,10 @@ class Calculate(Cmd):
             
             
             
-        f.write(str(self.residual[0]))
+        f.write(str(self.residual[0]) if len(self.residual) else "nan")
         f.write(" # residuals")
+        if self.note:
+            f.write("\n# "+self.note)
         f.close()
                 
     def leaveone(self):
@@ -102,36 +100,17 @@ class Calculate(Cmd):
         self.completeName2 = os.path.join(self.outpath, "LeaveOneOut.txt")  
         f2 = open(self.completeName2, 'w') # creates an output file
         # Prepares all the data for input into solving script
-        self.n = int(self.data[0])
-        self.volume = self.data[1]
-        self.eqenergy = self.data[2]
-        self.deltas = self.data[3:self.n+3]
-        self.energy = self.data[self.n+3:]
-        self.values = np.array([0.0]*(int(self.n-1)*28))
-        self.delt = np.array([0.0]*(int(self.n-1)))   
+        self.n = self.parser.ndeltas
+        self.volume = self.parser.volume
+        self.eqenergy = self.parser.eqenergy
+        self.deltas = self.parser.deltas
+        self.energy = self.parser.energies
         
-        # THe main "i" loop is responsible for omitting one set of data each time.
-        #This is done through integers being compared to the intiger on the values being sorted  
+        # The main "i" loop is responsible for omitting one set of data each time.
         # It also stores the values each time they are calculated.
-        #The "k" loop is for sorting value of strains 
-        #The "j" loop is for sorting the energy values
         for i in range(0, int(self.n)):
-            j=0
-            help2=0
-            help=0
-            # These help intigers are used to get rid of a line full of zeros.
-            #E.g. after omitting one set of data the next is safed into the place of the previous one, instead of leaving a blank space
-  
-            for k in range(0, int(self.n)):
-                if k!= i:
-                    self.delt[k-help] = self.deltas[k]
-                else:
-                    help=1 
-            for j in range (0,  int(self.n*28)):
-                if int(j/28)!= i:
-                    self.values[j-help2] = self.energy[j]
-                else:
-                    help2=28
+            self.delt = np.delete(self.deltas, i)
+            self.values = np.delete(self.energy, np.s_[28*i:28*(i+1)])
                
             a = Constants((self.n-1), self.volume, self.eqenergy,self.delt, self.values )
             self.results, residual = a.solve()
@@ -149,11 +128,80 @@ class Calculate(Cmd):
             f2.write("\n")
         f2.close() 
   
+class Parser:
+    """
+    This class reads the input file (see the example file) into one array of floats.
+    The header (number of strain values, volume, equilibrium energy), the strains and the energies are views into that array,
+    so nothing is copied after the file is read. Everything after # on a line is a comment.
+    The number of values is checked against 3 + n + 28*n, where n is the number of strain values
+    and every error names the line of the input file where it was found.
+    """
+    def __init__(self, filename, deformations=28):
+        self.filename = filename
+        self.deformations = deformations
+        
+    def read(self):
+        """Reads and checks the file. Returns the whole array, the parts are stored as ndeltas, volume, eqenergy, deltas and energies."""
+        f = open(self.filename, 'rb')
+        self.text = f.read()
+        f.close()
+        tokens = re.sub(rb"#[^\n]*", b"", self.text).split()
+        try:
+            self.data = np.array(tokens, dtype=float)
+        except ValueError:
+            for index, token in enumerate(tokens):
+                try:
+                    float(token)
+                except ValueError:
+                    self.error(index, "'%s' is not a number" %token.decode(errors="replace"))
+        
+        if len(self.data) < 3:
+            self.error(len(self.data), "the file must start with the number of strain values, the volume and the equilibrium energy")
+        n = self.data[0]
+        if not (np.isfinite(n) and n >= 1 and n == int(n)):
+            self.error(0, "the number of strain values must be a positive integer, got %s" %n)
+        if not self.data[1] > 0:
+            self.error(1, "the volume must be positive, got %s" %self.data[1])
+        n = int(n)
+        expected = 3+n+self.deformations*n
+        if len(self.data) != expected:
+            message = "expected %d values (3 + %d strains + %d*%d energies) but found %d" %(expected, n, self.deformations, n, len(self.data))
+            self.error(min(expected, len(self.data)), message)
+        
+        self.ndeltas = n
+        self.volume = self.data[1]
+        self.eqenergy = self.data[2]
+        self.deltas = self.data[3:3+n]
+        self.energies = self.data[3+n:]
+        return self.data
+        
+    def error(self, index, message):
+        """
+        Raises a ValueError for the value number index (counted from zero), naming the line it is on.
+        If the file has fewer values, the line of the last value is named.
+        """
+        line = 0
+        for number, text in enumerate(self.text.split(b"\n"), start=1):
+            values = len(text.split(b"#", 1)[0].split())
+            if values:
+                line = number
+            index -= values
+            if index < 0:
+                break
+        raise ValueError("%s, line %d: %s" %(self.filename, line, message))
+        
 class Constants:
     """This code calculates the SOECs and TOECs when given input of the form:"
     "Number of measurements, Volume, Eq. Energy, all strain values in a list and all the energies in another list"
     "The energies are in the order A1+, A1-, A2+, A2- for first strain and than repeated for the other values of strain"
-    "The solution is found using the least square method numpy.linalg.lstsq"""
+    "The solution is found using the least square method numpy.linalg.lstsq"
+    "Energies given as NaN (failed or missing calculations) are left out, and constants that the remaining energies"
+    "do not determine are returned as NaN"""
+    
+    # Names of the deformation matrices and of the constants, in the order of the energies and of the results
+    deformations = ("A1", "A2", "A3", "A4", "A7", "A8", "A9", "A10", "A11", "A12", "A13", "A14", "A15", "A16")
+    names = ("C11", "C12", "C13", "C14", "C33", "C44", "C111", "C112", "C113", "C114", "C123", "C124", "C133", "C134",
+             "C144", "C155", "C222", "C333", "C344", "C444")
           
     def __init__(self, ndeltas = 1, volume = 47.11, eqenergy = 0, delta = [0.021], energy = np.array([0.0, 0.0, 0.0, 0.0, 0.0, 0.0])):
         # the energies are stored with equilibirum energy as an independent variable,
@@ -178,25 +226,38 @@ class Constants:
         B is a 1-D array of energy density difference.
         The values in the X array are being calculated for given A and B
         """
-        i=0
-        a=[] # coefficient matrix
-        b = [] # right side matrix (inhomogenous part)
+        amatrix, determinants = self.equations()
+        #calculating the energy density, which is the result vector B (changing the energy to joules)
+        newb = (self.energy[:len(determinants)]-self.eqenergy)*160.217662000/(self.volume*determinants)
+        # rows of missing energies (NaN) are dropped, the rest of the data is used as it is
+        known = np.isfinite(newb)
+        self.missing = np.flatnonzero(~known)
+        amatrix, newb = amatrix[known], newb[known]
+        x, residues, rank, s = np.linalg.lstsq(amatrix, newb, rcond=None)
+        self.identified = self.identifiable(amatrix)
+        x[~self.identified] = np.nan
+
+        return x, residues
+        
+    def energies(self, constants):
+        """
+        The forward model of solve: returns the 28*ndeltas energies that the 20 constants give for the strains,
+        so that solve returns the constants exactly. Used to make synthetic input for tests and benchmarks.
+        """
+        amatrix, determinants = self.equations()
+        return self.eqenergy + amatrix @ np.asarray(constants, dtype=float)*self.volume*determinants/160.217662000
         
+    def equations(self):
+        """Returns the coefficient matrix A (28*ndeltas, 20) and the determinants of the deformations of all the energies."""
+        a=[] # coefficient matrix
+        determinants = []
         #Iterates over every strain value
         for i in range (0,int(self.ndeltas)):
             self.ddelta = self.delta[i]
             Constants.matrix(self)
             dltsquared = (self.delta[i]**2)/2
             dltcubed = abs(self.delta[i]**3)/6
-            
-            #calculating the energy density, which is the result vector B
-            x=0
-            for x in range (0,28):
-                count= x+(i*28)  
-                # pk4: make sure the energy calc is corret, but should be             
-                b.append((self.energy[count]-self.eqenergy)*160.217662000/(self.volume*self.determinant[x])) # changing the energy to joules                   
-    
-                
+            determinants.extend(self.determinant)
                     
         # matrix A with coefficients for matrix x with: C11, C111, C12, C112, C123, C44, C144, C166, C456        
             a.extend([[dltsquared, 0.0, 0.0, 0.0, 0.0, 0.0, dltcubed, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
@@ -229,11 +290,28 @@ class Constants:
                 [2*dltsquared, 2*dltsquared, 0.0, 0.0, 0.0, 4*dltsquared, 4*dltcubed, 6*dltcubed, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 12*dltcubed, 12*dltcubed, -2*dltcubed, 0.0, 0.0, 0.0],                
                 [2*dltsquared, 2*dltsquared, 0.0, 0.0, 0.0, 4*dltsquared, -4*dltcubed, -6*dltcubed, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, -12*dltcubed, -12*dltcubed, 2*dltcubed, 0.0, 0.0, 0.0]])
                      
-        newb = np.array(b)    
-        amatrix = np.matrix(a)
-        x, residues, rank, s = np.linalg.lstsq(amatrix, newb, rcond=None)
-
-        return x, residues
+        return np.array(a), np.array(determinants)
+        
+    def identifiable(self, a):
+        """
+        Returns for every constant whether the rows a determine it. A constant is not determined when a direction of the
+        null space of a (right singular vectors with zero singular value) changes it, since then any value of it fits equally well.
+        """
+        if len(a) == 0:
+            return np.zeros(a.shape[1], dtype=bool)
+        u, s, vt = np.linalg.svd(a)
+        rank = int(np.sum(s > max(a.shape)*np.finfo(float).eps*s[0]))
+        return np.sqrt(np.sum(vt[rank:]**2, axis=0)) < 1e-8
+        
+    def note(self):
+        """Describes the missing energies and the constants that are not determined, empty when all data was used."""
+        if len(self.missing) == 0:
+            return ""
+        text = "%d energies missing: %s" %(len(self.missing), ", ".join("%s%s at strain %s" %(self.deformations[i%28//2], "-" if i%2 else "+",
+                                                                                                self.delta[i//28]) for i in self.missing))
+        if not self.identified.all():
+            text += "; not determined: %s" %", ".join(np.array(self.names)[~self.identified])
+        return text
         
         
     def matrix(self):
@@ -313,4 +391,5 @@ class Constants:
             self.determinant[2*i+1] = abs(np.linalg.det(self.negmatrix))                        
             i+=1
    
-a = Main()
\ No newline at end of file
+if __name__ == "__main__":
+    a = Main()
\ No newline at end of file
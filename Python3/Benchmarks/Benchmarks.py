@@ -0,0 +1,263 @@
+import numpy as np
+from cmd import Cmd
+import sys
+import os.path
+import json
+import time
+import shutil
+import tempfile
+import tracemalloc
+import platform
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+folder = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(folder, "..", "Cubic_symmetry", "TrelaCalc_complete"))
+sys.path.insert(0, os.path.join(folder, "..", "Arbitrary_symmetry"))
+import TrelaCalc
+import arbitrary_symmetry
+
+
+class Main(Cmd):
+    """
+    This program measures how long the stages of TrelaCalc take and how much memory they need, for inputs of several sizes,
+    and checks that the results are still the numbers of the current implementation.
+    The input arguments are: the name of the JSON file for the results, then optional settings name=value:
+        strains: comma separated numbers of strain values of the fits and leave-one-out runs (default 3,14,50)
+        iteration: comma separated grids of directions for PostProcess.plotdata and plot (default 50,200)
+        steps: comma separated numbers of integration steps for Integration.solve (default 1000,10000)
+        sets: comma separated numbers of constant sets post-processed at once by Batch (default 100,10000)
+        repeat: how many times every stage is timed, the best and the median are stored (default 5)
+        compare: the JSON file of an earlier run, the times are printed next to each other
+    e.g: python3 Benchmarks.py results.json strains=3,14 repeat=3 compare=before.json
+    """
+    def __init__(self):
+        Cmd.__init__(self)
+        if (len(sys.argv) < 2):
+            self.outfile = input("Output file (JSON):")
+            self.options = {}
+        else:
+            self.outfile = str(sys.argv[1])
+            self.options = self.readoptions(sys.argv[2:])
+
+        sizes = lambda name, default: [int(x) for x in self.options.get(name, default).split(",")]
+        a = Suite(sizes("strains", "3,14,50"), sizes("iteration", "50,200"), sizes("steps", "1000,10000"),
+                  sizes("sets", "100,10000"), int(self.options.get("repeat", 5)))
+        a.check()
+        a.run()
+        a.store(self.outfile)
+        shutil.rmtree(a.folder)
+        if "compare" in self.options:
+            a.compare(self.options["compare"])
+        if not all(check["passed"] for check in a.checks):
+            sys.exit(1)
+
+    def readoptions(self, arguments):
+        """Optional settings are given in the form name=value. Returns a dictionary of the settings as strings."""
+        options = {}
+        for argument in arguments:
+            name, separator, value = argument.partition("=")
+            if not separator:
+                raise ValueError("Optional settings must be given as name=value, got '%s'" %argument)
+            options[name] = value
+        return options
+
+
+class Suite:
+    """
+    This class holds the benchmarks. The inputs are made by the forward models (TrelaCalc.Synthetic and the energies method of
+    arbitrary_symmetry.Constants), with a little noise, so any size can be measured without DFT data.
+    Every stage is timed repeat times with time.perf_counter and run once more under tracemalloc for the peak memory,
+    so the timing is not slowed down by the tracing. The stages are:
+        solve        Constants.solve, cubic (9 constants) and arbitrary symmetry (the trigonal set of 20 constants)
+        leaveone     Calculate.leaveone, cubic and arbitrary symmetry
+        integration  Integration.solve
+        batch        Batch (integration, young and polycrystal of many constant sets at once)
+        plotdata     PostProcess.plotdata
+        plot         PostProcess.plot (the three 3D graphs, saved as png)
+    The checks compare the results for the example inputs with the numbers of the current implementation.
+    """
+    # Results of the current implementation for the example inputs
+    cubic = [183.3511256595524, 132.973347278837, 79.60729978353706, -1714.0116724869108, -1156.871214930112, -443.453867840055,
+             -33.18121292964, -687.8545086729688, 70.59181287881039]
+    pressure = [190.7063846142658, 139.67490468294156, 81.49701149403792]
+    arbitrary = [554.850222392598, -49.81451374067538, -372.6368270439456, -126.39972541706376, 1265.9109995666738, 193.72542926077512,
+                 -153360.06936407124, 84154.74145801966, -30432.475869329555, 38758.87437989318, -3151.453659014805, -30353.4289701566,
+                 26784.181453027995, -13811.402671773732, -2825.725441976524, -4464.025136497491, -29066.79198823817, 2561.8796529433707,
+                 888.7372159597386, -10623.627672398308]
+    # trigonal constants for the synthetic inputs of the arbitrary symmetry (C11, C12, C13, C14, C33, C44, then the TOECs)
+    trigonal = [250., 70., 60., 15., 230., 80., -2000., -400., -300., 50., -100., 40., -900., 30., -150., -500., -1800., -1900., -600., 60.]
+    volume = 47.86
+    eqenergy = -15.0
+    noise = 0.001
+
+    def __init__(self, strains=(3, 14, 50), iterations=(50, 200), steps=(1000, 10000), sets=(100, 10000), repeat=5):
+        self.strains = list(strains)
+        self.iterations = list(iterations)
+        self.steps = list(steps)
+        self.sets = list(sets)
+        self.repeat = repeat
+        self.results = []
+        self.checks = []
+        self.rng = np.random.default_rng(0)
+        self.folder = tempfile.mkdtemp(prefix="TrelaCalc-benchmarks-")
+
+    def strainvalues(self, n):
+        return np.round(np.linspace(0.005, 0.05, n), 12)
+
+    def measure(self, stage, symmetry, parameters, function):
+        """Times function repeat times, then runs it once under tracemalloc, and stores the result."""
+        times = []
+        for i in range(self.repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter()-start)
+        tracemalloc.start()
+        function()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result = dict(stage=stage, symmetry=symmetry, parameters=parameters, best=min(times), median=float(np.median(times)),
+                      repeat=self.repeat, peakmemory=peak)
+        self.results.append(result)
+        print("%-12s %-10s %-28s best %10.4f s  median %10.4f s  peak %8.1f MB" %(stage, symmetry, self.label(parameters), result["best"],
+                                                                                   result["median"], peak/2**20), flush=True)
+        return result
+
+    def label(self, parameters):
+        return " ".join("%s=%s" %item for item in sorted(parameters.items()))
+
+    def cubicinput(self, n):
+        """Writes a synthetic cubic input with n strain values, returns its name without .txt."""
+        a = TrelaCalc.Synthetic(self.cubic, self.volume, self.eqenergy, self.strainvalues(n))
+        name = os.path.join(self.folder, "cubic%d" %n)
+        a.write(name+".txt", a.energies(self.noise, rng=self.rng))
+        return name
+
+    def arbitraryinput(self, n):
+        """Writes a synthetic input of the arbitrary symmetry with n strain values, returns its name without .txt."""
+        strains = self.strainvalues(n)
+        energies = arbitrary_symmetry.Constants(n, self.volume, self.eqenergy, strains).energies(self.trigonal)
+        energies = energies + self.noise*self.rng.standard_normal(len(energies))
+        name = os.path.join(self.folder, "arbitrary%d" %n)
+        f = open(name+".txt", 'w')
+        f.write("\n".join("%.17g" %value for value in [n, self.volume, self.eqenergy]+strains.tolist()+energies.tolist())+"\n")
+        f.close()
+        return name
+
+    def run(self):
+        """Runs all the stages for all the sizes."""
+        for n in self.strains:
+            strains = self.strainvalues(n)
+            a = TrelaCalc.Synthetic(self.cubic, self.volume, self.eqenergy, strains)
+            cubic = TrelaCalc.Constants(n, self.volume, self.eqenergy, strains, a.energies(self.noise, rng=self.rng))
+            self.measure("solve", "cubic", dict(strains=n), cubic.solve)
+            energies = arbitrary_symmetry.Constants(n, self.volume, self.eqenergy, strains).energies(self.trigonal)
+            arbitrary = arbitrary_symmetry.Constants(n, self.volume, self.eqenergy, strains,
+                                                     energies+self.noise*self.rng.standard_normal(len(energies)))
+            self.measure("solve", "arbitrary", dict(strains=n), arbitrary.solve)
+
+        for n in self.strains:
+            if n < 2:
+                continue
+            b = TrelaCalc.Calculate(self.cubicinput(n), self.folder)
+            self.measure("leaveone", "cubic", dict(strains=n), b.leaveone)
+            b = arbitrary_symmetry.Calculate()
+            b.initialize(self.arbitraryinput(n), self.folder)
+            self.measure("leaveone", "arbitrary", dict(strains=n), b.leaveone)
+
+        for steps in self.steps:
+            self.measure("integration", "cubic", dict(steps=steps), TrelaCalc.Integration(self.cubic, 10, steps).solve)
+
+        for sets in self.sets:
+            constants = np.array(self.cubic)*(1+0.01*self.rng.standard_normal((sets, 9)))
+            self.measure("batch", "cubic", dict(sets=sets, steps=1000), lambda: TrelaCalc.Batch(constants, 10, 1000))
+
+        for iteration in self.iterations:
+            c = TrelaCalc.PostProcess(self.cubic, self.folder, 10, iteration, 1000, plots=("none",))
+            self.measure("plotdata", "cubic", dict(iteration=iteration), lambda: c.plotdata(iteration))
+            def plot():
+                c.plot()
+                plt.close("all")
+            self.measure("plot", "cubic", dict(iteration=iteration), plot)
+
+    def compare(self, filename):
+        """Prints the best times of an earlier run next to these, for the benchmarks that both runs have."""
+        f = open(filename)
+        earlier = json.load(f)
+        f.close()
+        before = {(r["stage"], r["symmetry"], self.label(r["parameters"])): r for r in earlier["results"]}
+        print("# stage, symmetry, parameters, best time before and now (s), now/before")
+        for r in self.results:
+            key = (r["stage"], r["symmetry"], self.label(r["parameters"]))
+            if key in before:
+                print("%-12s %-10s %-28s %10.4f %10.4f %6.2f" %(key+(before[key]["best"], r["best"], r["best"]/before[key]["best"])))
+
+    def check(self):
+        """Compares the results for the example inputs and the synthetic round trips with the current implementation."""
+        def record(name, result, expected, rtol):
+            difference = float(np.max(abs(np.asarray(result)-expected)/np.maximum(abs(np.asarray(expected)), 1e-300)))
+            self.checks.append(dict(name=name, passed=bool(difference <= rtol), relativedifference=difference, tolerance=rtol))
+            print("%-40s %s (relative difference %.3g)" %(name, "ok" if difference <= rtol else "FAILED", difference), flush=True)
+
+        parser = TrelaCalc.Parser(os.path.join(folder, "..", "Cubic_symmetry", "TrelaCalc_complete", "example.txt"))
+        parser.read()
+        x = TrelaCalc.Constants(parser.ndeltas, parser.volume, parser.eqenergy, parser.deltas, parser.energies).solve()[0]
+        record("cubic example constants", x, self.cubic, 1e-10)
+        record("cubic example SOEC at 1 GPa", TrelaCalc.Integration(list(x), 1.0, 1000).solve()[-1], self.pressure, 1e-7)
+        record("batch integration against odeint", TrelaCalc.Batch([x], 1.0, 1000).c[0], self.pressure, 1e-7)
+
+        parser = arbitrary_symmetry.Parser(os.path.join(folder, "..", "Arbitrary_symmetry", "example.txt"))
+        parser.read()
+        x = arbitrary_symmetry.Constants(parser.ndeltas, parser.volume, parser.eqenergy, parser.deltas, parser.energies).solve()[0]
+        record("arbitrary example constants", x, self.arbitrary, 1e-8)
+
+        strains = self.strainvalues(5)
+        a = TrelaCalc.Synthetic(self.cubic, self.volume, self.eqenergy, strains)
+        x = TrelaCalc.Constants(5, self.volume, self.eqenergy, strains, a.energies()).solve()[0]
+        record("cubic synthetic round trip", x, self.cubic, 1e-8)
+        energies = arbitrary_symmetry.Constants(5, self.volume, self.eqenergy, strains).energies(self.trigonal)
+        x = arbitrary_symmetry.Constants(5, self.volume, self.eqenergy, strains, energies).solve()[0]
+        record("arbitrary synthetic round trip", x, self.trigonal, 1e-8)
+        x = TrelaCalc.Constants(5, self.volume, self.eqenergy, strains, a.energies()).solve(a.stresses())[0]
+        record("cubic synthetic joint round trip", x, self.cubic, 1e-8)
+        
+        # stresses of an independent hyperelastic model, fitted together with the energies
+        F = np.eye(3) + a.strain[:, None, None]*TrelaCalc.Constants.deformations[a.deformation]
+        stress = np.array([self.hyperelastic(self.cubic, deformation) for deformation in F])
+        x = TrelaCalc.Constants(5, self.volume, self.eqenergy, strains, a.energies()).solve(stress)[0]
+        record("cubic joint fit of hyperelastic stresses", x, self.cubic, 1e-8)
+        
+    def hyperelastic(self, constants, F, h=1e-30):
+        """
+        Returns the Cauchy stress (xx, yy, zz, yz, xz, xy) of a cubic crystal with the deformation F, independently of TrelaCalc:
+        the energy density is the cubic expansion written out in the Lagrangian strain eta = 1/2 (F^T F - I) (Voigt, doubled shears),
+        its derivative by F (first Piola-Kirchhoff stress P) is taken by complex steps and sigma = P F^T / det F.
+        """
+        C11, C12, C44, C111, C112, C123, C144, C166, C456 = constants
+        def energy(F):
+            eta = 0.5*(F.T @ F - np.eye(3))
+            e1, e2, e3, e4, e5, e6 = eta[0, 0], eta[1, 1], eta[2, 2], 2*eta[1, 2], 2*eta[0, 2], 2*eta[0, 1]
+            return (0.5*C11*(e1**2+e2**2+e3**2) + C12*(e1*e2+e2*e3+e3*e1) + 0.5*C44*(e4**2+e5**2+e6**2)
+                    + C111*(e1**3+e2**3+e3**3)/6 + 0.5*C112*(e1**2*(e2+e3)+e2**2*(e1+e3)+e3**2*(e1+e2)) + C123*e1*e2*e3
+                    + 0.5*C144*(e1*e4**2+e2*e5**2+e3*e6**2) + 0.5*C166*(e4**2*(e2+e3)+e5**2*(e1+e3)+e6**2*(e1+e2)) + C456*e4*e5*e6)
+        P = np.zeros((3, 3))
+        for i in range(3):
+            for j in range(3):
+                step = np.zeros((3, 3), dtype=complex)
+                step[i, j] = 1j*h
+                P[i, j] = energy(F+step).imag/h
+        sigma = P @ F.T/np.linalg.det(F)
+        return np.array([sigma[0, 0], sigma[1, 1], sigma[2, 2], sigma[1, 2], sigma[0, 2], sigma[0, 1]])
+
+    def store(self, filename):
+        """Writes the results, the checks and a description of the machine to the JSON file."""
+        summary = dict(date=time.strftime("%Y-%m-%d %H:%M:%S"), python=platform.python_version(), numpy=np.__version__,
+                       machine=platform.platform(), processor=platform.processor(), results=self.results, checks=self.checks)
+        f = open(filename, 'w')
+        f.write(json.dumps(summary, indent=1))
+        f.close()
+
+
+if __name__ == "__main__":
+    a = Main()
@@ -0,0 +1,213 @@
+from cmd import Cmd
+from concurrent.futures import ThreadPoolExecutor
+import xml.etree.ElementTree as ET
+import numpy as np
+import re
+import sys
+import os.path
+
+
+class Main(Cmd):
+    def __init__(self):
+        """
+        This program collects the results of the quantum (VASP) calculations of the deformed structures into an input file of TrelaCalc.
+        The input arguments are: Campaign folder, Output file, symmetry (cubic or arbitrary, cubic by default), number of threads (8 by default)
+        and the layout of the output file (blocks by default, or long for TrelaCalc's layout=long, cubic only).
+        The campaign folder must be laid out as the Matrices.py script writes it:
+            reference/                  the calculation at zero strain (equilibrium energy and volume)
+            strain_0.007/A1_pos/        one folder for every strain value and every deformation matrix with positive (pos)
+            strain_0.007/A1_neg/        and negative (neg) strain: A1...A6 for cubic, A1...A4 and A7...A16 for arbitrary symmetry
+        Each folder must hold an OUTCAR or a vasprun.xml. The output file is written without the .txt extension in the working directory.
+        With the long layout every deformation may have its own strains: folders that do not exist are skipped and one line
+        (deformation, sign, strain, energy) is written for every calculation that does.
+        """
+        if (len(sys.argv) < 3):
+            self.campaign = input("Campaign folder:")
+            self.outfile = input("Output file:")
+            self.symmetry = input("Symmetry (cubic or arbitrary):") or "cubic"
+            self.workers = 8
+            self.layout = "blocks"
+
+        else:
+            self.campaign = str(sys.argv[1])
+            self.outfile = str(sys.argv[2])
+            self.symmetry = str(sys.argv[3]) if len(sys.argv) > 3 else "cubic"
+            self.workers = int(sys.argv[4]) if len(sys.argv) > 4 else 8
+            self.layout = str(sys.argv[5]) if len(sys.argv) > 5 else "blocks"
+
+        a = Campaign(self.campaign, self.symmetry, self.workers, self.layout)
+        a.read()
+        if a.unfinished:
+            sys.exit("%d calculations are missing or unfinished, no file is written:\n%s" %(len(a.unfinished), "\n".join(a.unfinished)))
+        a.write(self.outfile+".txt")
+        print("%d strain values, %d calculations read from %s" %(a.ndeltas, len(a.energies), self.campaign))
+
+
+class Campaign:
+    """
+    This class walks the folder of a campaign of deformation calculations and assembles the input of TrelaCalc:
+    the number of strain values, the volume and energy at zero strain, the strain values and the energies in the order
+    A1(strain>0), A1(strain<0), A2(strain>0)... for every strain value, smallest strain first.
+    All the calculations are read in parallel by a pool of threads.
+    """
+    # Names of the deformation matrices, in the order of the energies in the input file
+    deformations = {"cubic": ("A1", "A2", "A3", "A4", "A5", "A6"),
+                    "arbitrary": ("A1", "A2", "A3", "A4", "A7", "A8", "A9", "A10", "A11", "A12", "A13", "A14", "A15", "A16")}
+
+    def __init__(self, path, symmetry="cubic", workers=8, layout="blocks"):
+        if symmetry not in self.deformations:
+            raise ValueError("Unknown symmetry '%s', use cubic or arbitrary" %symmetry)
+        if layout not in ("blocks", "long") or (layout == "long" and symmetry != "cubic"):
+            raise ValueError("Unknown layout '%s', use blocks or long (long only for cubic symmetry)" %layout)
+        self.path = path
+        self.symmetry = symmetry
+        self.workers = workers
+        self.layout = layout
+
+    def runs(self):
+        """
+        Returns the strain values (sorted) and the folders of all the calculations in the order of the input file.
+        For the long layout only the folders that exist are returned, and self.rows holds their deformation number, sign and strain.
+        """
+        strains = []
+        for entry in os.scandir(self.path):
+            if entry.is_dir() and entry.name.startswith("strain_"):
+                strains.append((float(entry.name[len("strain_"):]), entry.name))
+        strains.sort()
+        folders = []
+        self.rows = []
+        for strain, name in strains:
+            for k, deformation in enumerate(self.deformations[self.symmetry], 1):
+                for sign, suffix in ((1, "pos"), (-1, "neg")):
+                    folder = os.path.join(self.path, name, "%s_%s" %(deformation, suffix))
+                    if self.layout == "long" and not os.path.isdir(folder):
+                        continue
+                    folders.append(folder)
+                    self.rows.append((k, sign, strain))
+        return np.array([strain for strain, name in strains]), folders
+
+    def read(self):
+        """
+        Reads the reference and all the deformed calculations. The folders of the calculations that are missing or unfinished
+        (including the reference) are listed in unfinished, and their energies are NaN.
+        """
+        self.deltas, folders = self.runs()
+        if len(self.deltas) == 0:
+            raise ValueError("No strain_* folders found in %s" %self.path)
+        self.ndeltas = len(self.deltas)
+        reference = Run(os.path.join(self.path, "reference")).result(volume=True)
+        self.eqenergy, self.volume = reference if reference is not None else (np.nan, np.nan)
+
+        pool = ThreadPoolExecutor(self.workers)
+        results = list(pool.map(lambda folder: Run(folder).energy(), folders))
+        pool.shutdown()
+        self.unfinished = [folder for folder, energy in zip([os.path.join(self.path, "reference")]+folders, [reference]+results) if energy is None]
+        self.energies = np.array([np.nan if energy is None else energy for energy in results])
+        return self.energies
+
+    def write(self, filename):
+        """Writes the input file of TrelaCalc in one go."""
+        if self.layout == "long":
+            lines = ["%r\t# Volume at zero strain in Angstroem cubed" %float(self.volume),
+                     "%r\t# Equilibrium energy at zero strain in eV" %float(self.eqenergy),
+                     "# deformation, sign, strain, energy"]
+            lines.extend("%d %d %r %r" %(k, sign, float(strain), float(energy)) for (k, sign, strain), energy in zip(self.rows, self.energies))
+            f = open(filename, 'w')
+            f.write("\n".join(lines)+"\n")
+            f.close()
+            return
+        lines = ["%d\t# number of strain values" %self.ndeltas,
+                 "%r\t# Volume at zero strain in Angstroem cubed" %float(self.volume),
+                 "%r\t# Equilibrium energy at zero strain in eV" %float(self.eqenergy)]
+        lines.extend(repr(float(delta)) for delta in self.deltas)
+        lines.extend(repr(float(energy)) for energy in self.energies)
+        f = open(filename, 'w')
+        f.write("\n".join(lines)+"\n")
+        f.close()
+
+
+class Run:
+    """
+    This class reads the final energy (energy(sigma->0)) and volume of one finished VASP calculation.
+    A calculation is finished when its OUTCAR ends with the timing ("General timing and accounting") or its vasprun.xml is closed
+    (</modeling>); only the end of the file is read for this check, so unfinished calculations cost almost nothing.
+    The OUTCAR is preferred: only its end is read, going further back only when the values are not found.
+    Otherwise the vasprun.xml is parsed incrementally with iterparse and every element is dropped once it is read.
+    Watch in TrelaCalc uses the same reader while a campaign is running.
+    """
+    # the text that only a finished calculation has near the end of the file
+    finished = {"OUTCAR": b"General timing and accounting", "vasprun.xml": b"</modeling>"}
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def energy(self):
+        """Returns the final energy in eV or None if the calculation is missing or unfinished."""
+        result = self.result()
+        return None if result is None else result[0]
+
+    def result(self, volume=False):
+        """Returns the final energy and the volume (None unless asked for), or None if the calculation is missing or unfinished."""
+        try:
+            return self.read(volume)
+        except (OSError, ValueError, ET.ParseError):
+            return None
+
+    def read(self, volume=False):
+        """Returns the final energy and the volume (None unless asked for). Raises an error if the calculation is missing or unfinished."""
+        for name, reader in (("OUTCAR", self.outcar), ("vasprun.xml", self.vasprun)):
+            filename = os.path.join(self.folder, name)
+            if os.path.exists(filename):
+                if not self.done(filename, self.finished[name]):
+                    raise ValueError("%s is not finished" %filename)
+                return reader(filename, volume)
+        raise OSError("No OUTCAR or vasprun.xml in %s" %self.folder)
+
+    def done(self, filename, marker, chunk=65536):
+        """Checks whether the marker of a finished calculation is in the last chunk bytes of the file."""
+        f = open(filename, 'rb')
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(0, size-chunk))
+        text = f.read()
+        f.close()
+        return marker in text
+
+    def outcar(self, filename, volume=False, chunk=65536):
+        """Reads the end of the OUTCAR, doubling the part that is read until the last energy (and volume) is found."""
+        f = open(filename, 'rb')
+        size = f.seek(0, os.SEEK_END)
+        energy = cell = None
+        while True:
+            start = max(0, size-chunk)
+            f.seek(start)
+            text = f.read(size-start)
+            energies = re.findall(rb"energy\(sigma->0\) =\s*(\S+)", text)
+            volumes = re.findall(rb"volume of cell :\s*(\S+)", text) if volume else [b"0"]
+            if energies and volumes:
+                energy, cell = float(energies[-1]), float(volumes[-1])
+                break
+            if start == 0:
+                break
+            chunk *= 2
+        f.close()
+        if energy is None:
+            raise ValueError("No final energy in %s" %filename)
+        return energy, cell if volume else None
+    def vasprun(self, filename, volume=False):
+        """Reads the last e_0_energy (energy of the last ionic step) and the last volume (final structure) of the vasprun.xml."""
+        energy = cell = None
+        for event, element in ET.iterparse(filename):
+            if element.tag == "i":
+                name = element.get("name")
+                if name == "e_0_energy":
+                    energy = float(element.text)
+                elif name == "volume":
+                    cell = float(element.text)
+            elif element.tag in ("calculation", "structure", "varray", "scstep"):
+                element.clear()
+        if energy is None:
+            raise ValueError("No final energy in %s" %filename)
+        return energy, cell if volume else None
+
+if __name__ == "__main__":
+    a = Main()
@@ -1,72 +1,198 @@
 import numpy as np
 from cmd import Cmd
+import shutil
 import sys
+import os.path
 
 class Main(Cmd):
     """
-    This program create the necessary deformation matrices that is needed for ab initio calculations. 
+    This program create the necessary deformation matrices that is needed for ab initio calculations.
     The format is adjusted to serve as input for VASP.
     12 matrices are generated based on six matrices A1-A6 and a positive and negative delta.
     The input of this script is a value of delta and a name of the output file without .txt .
     e.g: a=Main(0.021, "matrices")
+    With a reference POSCAR, a list of strains and a campaign folder, the deformed POSCARs of all the strains are written instead,
+    one folder for every calculation, in the layout read by DFT_ingestion/Ingest.py:
+    e.g: python3 Matrices.py POSCAR 0.007,0.014,0.021 Campaign cubic
     """
     def __init__(self):
-        if (len(sys.argv)!= 3): 
-           
+        if (len(sys.argv) in (4, 5)):
+            self.poscar = str(sys.argv[1])
+            self.strains = self.readstrains(sys.argv[2])
+            self.campaign = str(sys.argv[3])
+            self.symmetry = str(sys.argv[4]) if len(sys.argv) > 4 else "cubic"
+            a = Campaign(self.poscar, self.strains, self.symmetry)
+            a.write(self.campaign)
+            print("%d strain values, %d deformed structures written to %s" %(len(self.strains), a.lattices.shape[0]*a.lattices.shape[1]*2, self.campaign))
+            return
+
+        if (len(sys.argv)!= 3):
+
             self.delta = float(input("Strain:"))
-            self.filename = input("Output file:") 
+            self.filename = input("Output file:")
 
         else:
             self.delta = float(sys.argv[1])
             self.filename = str(sys.argv[2])
-            
+
         self.f = open(self.filename+".txt", 'w')
         self.calculate()
-        
+
+    def readstrains(self, text):
+        """The strains are given separated by commas or as a file with one strain on a line."""
+        if os.path.exists(text):
+            return np.atleast_1d(np.loadtxt(text, comments="#"))
+        return np.array([float(strain) for strain in text.split(",")])
+
     def calculate(self):
         """
         This method contains the formulas of the matrices which are added to a Identity matix,
         to produce the defromation matrices for a given delta."""
-        self.base = np.array([[1.0, 0., 0.],
-                                [0., 1.0, 0.],
-                                [0., 0., 1.0]])
-                                
-        self.A1 = np.array([[self.delta, 0., 0.],
-                                [0., 0., 0.],
-                                [0., 0., 0.]])
-                                
-        self.A2 = np.array([[self.delta, 0., 0.],
-                                [0., self.delta, 0.],
-                                [0., 0., 0.]])
-                                
-        self.A3 = np.array([[self.delta, 0., 0.],
-                                [0., self.delta, 0.],
-                                [0., 0., self.delta]])
-                                
-        self.A4 = np.array([[self.delta, 0., 0.],
-                                [0., 0., self.delta],
-                                [0., self.delta, 0.]])
-                                
-        self.A5 = np.array([[self.delta, self.delta, 0.],
-                                [self.delta, 0., 0.],
-                                [0., 0., 0.]])
-            
-        self.A6 = np.array([[0., self.delta, self.delta],
-                                [self.delta, 0., self.delta],
-                                [self.delta, self.delta, 0.]])    
-                             
-        i=1
-        self.list = (self.A1, self.A2, self.A3, self.A4, self.A5, self.A6)
-        for matrix in self.list:
-            self.matrix=self.base+matrix
-            self.negmatrix = self.base-matrix
-            self.f.write("#A%s for delta =%s: \n" %(i, self.delta))
-            self.f.write('\n'.join('  '.join(str(cell) for cell in row) for row in self.matrix))   
-            self.f.write(" \n#A%s for delta = -%s: \n" %(i, self.delta))
-            self.f.write('\n'.join('  '.join(str(cell) for cell in row) for row in self.negmatrix))
-            self.f.write(" \n\n")
-            i+=1
-
-        self.f.close() 
-        
-a=Main()
\ No newline at end of file
+        matrices = Deformations("cubic").matrices(np.array([self.delta]))[0]
+        lines = []
+        for i, (matrix, negmatrix) in enumerate(matrices, 1):
+            lines.append("#A%s for delta =%s: " %(i, self.delta))
+            lines.append('\n'.join('  '.join(str(cell) for cell in row) for row in matrix)+" ")
+            lines.append("#A%s for delta = -%s: " %(i, self.delta))
+            lines.append('\n'.join('  '.join(str(cell) for cell in row) for row in negmatrix)+" ")
+            lines.append("")
+        self.f.write("\n".join(lines)+"\n")
+        self.f.close()
+
+
+class Deformations:
+    """
+    This class holds the patterns of the deformation matrices A1-A6 (cubic) or A1-A4, A7-A16 (arbitrary symmetry),
+    in the same order as the energies are expected by TrelaCalc and arbitrary_symmetry.
+    The deformation matrix for a strain delta is the identity plus (A(strain>0)) or minus (A(strain<0)) delta times the pattern.
+    """
+    patterns = {"cubic": (("A1", [[1, 0, 0], [0, 0, 0], [0, 0, 0]]),
+                          ("A2", [[1, 0, 0], [0, 1, 0], [0, 0, 0]]),
+                          ("A3", [[1, 0, 0], [0, 1, 0], [0, 0, 1]]),
+                          ("A4", [[1, 0, 0], [0, 0, 1], [0, 1, 0]]),
+                          ("A5", [[1, 1, 0], [1, 0, 0], [0, 0, 0]]),
+                          ("A6", [[0, 1, 1], [1, 0, 1], [1, 1, 0]])),
+                "arbitrary": (("A1", [[1, 0, 0], [0, 0, 0], [0, 0, 0]]),
+                              ("A2", [[1, 0, 0], [0, 1, 0], [0, 0, 0]]),
+                              ("A3", [[1, 0, 0], [0, 1, 0], [0, 0, 1]]),
+                              ("A4", [[1, 0, 0], [0, 0, 1], [0, 1, 0]]),
+                              ("A7", [[0, 0, 0], [0, 1, 0], [0, 0, 0]]),
+                              ("A8", [[0, 0, 0], [0, 0, 0], [0, 0, 1]]),
+                              ("A9", [[0, 0, 0], [0, 1, 0], [0, 0, 1]]),
+                              ("A10", [[0, 0, 0], [0, 0, 1], [0, 1, 0]]),
+                              ("A11", [[0, 1, 0], [1, 0, 0], [0, 0, 1]]),
+                              ("A12", [[0, 0, 0], [0, 1, 1], [0, 1, 0]]),
+                              ("A13", [[0, 0, 1], [0, 1, 0], [1, 0, 0]]),
+                              ("A14", [[0, 0, 1], [0, 0, 0], [1, 0, 1]]),
+                              ("A15", [[1, 0, 0], [0, 0, 1], [0, 1, 1]]),
+                              ("A16", [[1, 0, 1], [0, 1, 0], [1, 0, 0]]))}
+
+    def __init__(self, symmetry="cubic"):
+        if symmetry not in self.patterns:
+            raise ValueError("Unknown symmetry '%s', use cubic or arbitrary" %symmetry)
+        self.names = [name for name, pattern in self.patterns[symmetry]]
+        self.pattern = np.array([pattern for name, pattern in self.patterns[symmetry]], float)
+
+    def matrices(self, strains):
+        """Returns all the deformation matrices at once, shape (strains, deformations, 2 (strain>0, strain<0), 3, 3)."""
+        signed = np.asarray(strains, float)[:, None]*np.array([1.0, -1.0])
+        return np.eye(3)+signed[:, None, :, None, None]*self.pattern[None, :, None]
+
+
+class Campaign:
+    """
+    This class applies every deformation matrix to the lattice (and Cartesian positions) of a reference POSCAR
+    and writes the folders of the campaign:
+        reference/POSCAR            the undeformed structure
+        strain_0.007/A1_pos/POSCAR  the structure deformed by A1 with strain 0.007
+        strain_0.007/A1_neg/POSCAR  the structure deformed by A1 with strain -0.007 ...
+    The lattice vectors are the rows of the POSCAR, so all the deformed lattices are one product L F^T.
+    INCAR, KPOINTS and POTCAR found next to the reference POSCAR are copied into every folder.
+    """
+    inputs = ("INCAR", "KPOINTS", "POTCAR")
+
+    def __init__(self, poscar, strains, symmetry="cubic"):
+        self.reference = Poscar(poscar)
+        self.strains = np.asarray(strains, float)
+        self.deformations = Deformations(symmetry)
+        F = self.deformations.matrices(self.strains)
+        self.lattices = np.einsum('kj,...ij->...ki', self.reference.lattice, F)
+        if self.reference.cartesian:
+            self.positions = np.einsum('kj,...ij->...ki', self.reference.positions, F)
+        else:
+            self.positions = None
+
+    def write(self, path):
+        """Writes the reference and all the deformed structures, one write per file."""
+        folder = os.path.dirname(os.path.abspath(self.reference.filename))
+        inputs = [os.path.join(folder, name) for name in self.inputs if os.path.exists(os.path.join(folder, name))]
+        self.writerun(os.path.join(path, "reference"), self.reference.text(), inputs)
+        for i, strain in enumerate(self.strains):
+            for j, name in enumerate(self.deformations.names):
+                for k, sign in enumerate(("pos", "neg")):
+                    positions = None if self.positions is None else self.positions[i, j, k]
+                    text = self.reference.text(self.lattices[i, j, k], positions)
+                    self.writerun(os.path.join(path, "strain_%r" %float(strain), "%s_%s" %(name, sign)), text, inputs)
+
+    def writerun(self, folder, text, inputs):
+        os.makedirs(folder, exist_ok=True)
+        f = open(os.path.join(folder, "POSCAR"), 'w')
+        f.write(text)
+        f.close()
+        for filename in inputs:
+            shutil.copyfile(filename, os.path.join(folder, os.path.basename(filename)))
+
+
+class Poscar:
+    """
+    This class reads a VASP POSCAR (VASP 4 or 5 format, with or without selective dynamics, Direct or Cartesian coordinates)
+    and writes it again with a new lattice and positions. A negative scaling factor (the volume) is turned into the
+    equivalent positive factor, so that the deformations are applied to the true lattice.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        f = open(filename)
+        lines = f.read().splitlines()
+        f.close()
+        self.comment = lines[0]
+        self.scale = float(lines[1].split()[0])
+        self.lattice = np.array([[float(x) for x in line.split()[:3]] for line in lines[2:5]])
+        if self.scale < 0:
+            self.scale = (-self.scale/abs(np.linalg.det(self.lattice)))**(1/3)
+        i = 5
+        self.species = None
+        if not lines[i].split()[0].isdigit():
+            self.species = lines[i]
+            i += 1
+        self.counts = lines[i]
+        natoms = sum(int(x) for x in lines[i].split())
+        i += 1
+        self.selective = None
+        if lines[i].strip()[:1] in ("S", "s"):
+            self.selective = lines[i]
+            i += 1
+        self.mode = lines[i]
+        self.cartesian = lines[i].strip()[:1] in ("C", "c", "K", "k")
+        i += 1
+        rows = [line.split() for line in lines[i:i+natoms]]
+        if len(rows) < natoms or any(len(row) < 3 for row in rows):
+            raise ValueError("%s: expected %d atomic positions" %(filename, natoms))
+        self.positions = np.array([[float(x) for x in row[:3]] for row in rows])
+        self.rest = [" ".join(row[3:]) for row in rows]
+
+    def text(self, lattice=None, positions=None):
+        """Returns the POSCAR as a string, optionally with a new lattice and new (Cartesian) positions."""
+        lattice = self.lattice if lattice is None else lattice
+        positions = self.positions if positions is None else positions
+        lines = [self.comment, "%.16f" %self.scale]
+        lines.extend("  %22.16f%22.16f%22.16f" %tuple(row) for row in lattice)
+        if self.species is not None:
+            lines.append(self.species)
+        lines.append(self.counts)
+        if self.selective is not None:
+            lines.append(self.selective)
+        lines.append(self.mode)
+        lines.extend(("  %20.16f%20.16f%20.16f %s" %(tuple(row)+(rest,))).rstrip() for row, rest in zip(positions, self.rest))
+        return "\n".join(lines)+"\n"
+
+a=Main()
@@ -1,6 +1,13 @@
 from cmd import Cmd
 import sys
 import os.path
+import json
+import re
+import shlex
+import struct
+import itertools
+import time
+import zipfile
 import math 
 import matplotlib
 import matplotlib.pyplot as plt
@@ -10,6 +17,10 @@ import numpy as np
 
 
 class Main(Cmd):
+    # The tasks that are called with a command in place of the input file, any other first argument is an input file
+    commands = ("replot", "stream", "watch", "design", "recommend", "explore", "truncation", "synthetic", "montecarlo")
+    outputprompt = "Output folder(Select or create a folder to which data is stored):"
+
     def __init__(self):    
         """
         The is the complete version of TrelaCalc. It calculates second and third order elastic constants (SOEC, TOEC) from
@@ -32,20 +43,58 @@ class Main(Cmd):
                 If only numerical results are needed it can be set to 1 which will greatly decrease the computing time.
             The number of integration steps is for calculating the pressure derivatives. The effect on computing time is small.
                 For normal pressure changes like 1,10,100 GPa the effect of n. of iteration steps is also small. However a 1000 is used as a standart value. 
+        Optional settings can follow the five arguments in the form name=value:
+            plotres: resolution of the plotted surfaces, independent of the number of iteration steps (numeric resolution).
+                By default it is half of the number of iteration steps, which gives the same plots as before.
+            plots: comma separated list of the graphs to produce: 3d (default), stereo, equalarea or none.
+                stereo and equalarea are fast 2D maps of the standard triangle in stereographic or equal-area projection.
+            planes: comma separated Miller indices of planes, e.g. 001,110,111. The Young moduli along the great circle in each plane
+                are plotted in polar graphs and stored as columns of a csv file. sectionres sets the number of angles (360 by default).
+            mesh: comma separated mesh formats (ply, vtk, obj) to which the surface is exported at the numeric resolution (iteration steps).
+            cmap, title: the colour map of the graphs (jet by default) and a title that is put in front of the graph titles.
+            artifact: npz or mmap stores all computed arrays into Artifact.npz (compressed, or uncompressed to be loaded memory-mapped).
+            layout: blocks (default, the form of example.txt) or long, a table with one energy per line:
+                deformation (1-6 for A1-A6), sign (1 or -1), strain, energy, so that every deformation can have its own strains.
+            stress: a file with the stresses of the calculations (xx, yy, zz, yz, xz, xy in GPa, one calculation per line in the order
+                of the energies), which are fitted together with the energies, six equations more for every calculation.
+            formats: comma separated machine-readable outputs written next to the text files, in full precision:
+                json (Summary.json), csv (Constants.csv, LeaveOneOut.csv, Trajectory.csv) and npz (Results.npz).
+            diagnostics: 1 writes the diagnostics of the fit as well: Influence.txt, Residuals.txt, Uncertainties.txt and Jackknife.txt
+                (and the standard errors in Summary.json and Results.npz). By default only the files of the former versions are written.
+        Other tasks are called with a command in place of the input file:
+            replot Output [name=value ...]: regenerates the graphs from Output/Artifact.npz without recomputing anything.
+            stream Input Output [batchsize=1000]: calculates the constants of every material in an input file with many records.
+            watch Campaign Output [interval=60 tolerance=0.001 patience=2 timeout=0]: updates the constants while the calculations of a campaign finish.
+            design Output [volume=... noise=0.001 strains=0.005:0.06:0.005 maxstrains=4 targets=C11:2,C456:5 criterion=D top=20]:
+                searches the strain sets, deformations and signs of a campaign for the cheapest one that meets the target uncertainties.
+            recommend Input Output [layout=blocks noise=0 strains=0.005:0.06:0.005 target=auto top=20]:
+                ranks the single calculations that would most reduce the uncertainty of a constant, after a partial campaign.
+            truncation Input Output [layout=blocks tolerance=0.05 minstrains=3]: checks up to which strain the cubic expansion holds.
+            explore Input Output [layout=blocks mode=windows,omit maxsize=2 minstrains=3 judge=C11,C12,... top=20]:
+                fits every window of neighbouring strains and every set with up to maxsize strains omitted, and ranks them by stability.
+            synthetic Output [constants=... strains=... noise=0 quartic=0 records=1 ...]: writes the energies (and stresses) that given
+                constants imply, as an input file, for tests and benchmarks without DFT.
+            montecarlo Input Output [layout=blocks noise=0 samples=10000 pressure=1 steps=1000 seed=]:
+                the distributions of the constants and derived results for noisy energies, all the samples solved at once.
         The output are three files and three graphs: Constants.txt contains the SOEC and TOEC calculated from all the available data.
         LeaveOneOut.txt calculates the constants while omitting one set of data. This is a consistency check.
         Additional data.txt contains other properties of material such as: anisotropy, directional Young moduli, SOEC, all at zero and user-defined pressure.
             It also contains some polycrystalline properties like shear.
         Three graphs are produced: Young moduli (E) at zero pressure, the difference in E for given difference in pressure and the same graph normalized, all as a function of direction               
         """ 
+        Cmd.__init__(self)
+        if len(sys.argv) > 1 and sys.argv[1] in self.commands:
+            self.onecmd(" ".join(shlex.quote(argument) for argument in sys.argv[1:]))
+            return
                   
-        if (len(sys.argv)!= 6): 
+        if (len(sys.argv) < 6): 
            
             self.inp = input("Input file:") 
-            self.outfile = input("Output folder(Select or create a folder to which data is stored):") 
+            self.outfile = input(self.outputprompt) 
             self.pressure = float(input("Pressure:"))
             self.iteration = int(input("number of iteration steps for surface integral (200-300 recomended):"))
             self.steps = int(input("number of integration steps(1000 is a standart value):"))
+            self.options = {}
 
         else:
 
@@ -54,6 +103,7 @@ class Main(Cmd):
             self.pressure = float(sys.argv[3])
             self.iteration = int(sys.argv[4])
             self.steps = int(sys.argv[5])
+            self.options = self.readoptions(sys.argv[6:])
             
 
         if self.outfile!="":
@@ -61,9 +111,231 @@ class Main(Cmd):
                 os.makedirs(self.outfile)
 
   
-        b = Calculate(self.inp, self.outfile)
-        c = PostProcess(b.constants, self.outfile, self.pressure, self.iteration, self.steps)
+        self.formats = self.options["formats"].split(",") if "formats" in self.options else []
+        for kind in self.formats:
+            if kind not in ("json", "csv", "npz"):
+                raise ValueError("Unknown output format '%s', use json, csv or npz" %kind)
+        self.diagnostics = self.options.get("diagnostics", "0") not in ("0", "")
+        b = Calculate(self.inp, self.outfile, self.formats, self.options.get("layout", "blocks"), self.options.get("stress"), self.diagnostics)
+        if np.isnan(b.constants).any():
+            raise ValueError("The available energies do not determine %s, no post-processing is possible"
+                             %", ".join(np.array(Constants.names)[np.isnan(b.constants)]))
+        c = PostProcess(b.constants, self.outfile, self.pressure, self.iteration, self.steps,
+                        artifact=self.options.get("artifact", ""), formats=self.formats,
+                        covariance=b.covariance if self.diagnostics else None,
+                        **self.plotoptions(self.options))
+        if self.diagnostics and len(b.loo) > 1 and np.isfinite(b.loo).all():
+            d = Batch(np.vstack([b.constants, b.loo]), self.pressure, self.steps)
+            d.jackknife()
+            d.store(os.path.join(self.outfile, "Jackknife.txt"))
+        self.export(b, c)
+        
+    def export(self, b, c):
+        """
+        Writes the results of the calculation (b) and of the post-processing (c) together:
+        Summary.json with all the single values and the leave-one-out sets, Results.npz with all the arrays. Each file is written at once.
+        """
+        if "json" in self.formats:
+            summary = dict(input=self.inp, pressure=float(self.pressure), iteration=self.iteration, steps=self.steps)
+            summary.update(b.summary())
+            summary.update(c.summary())
+            f = open(os.path.join(self.outfile, "Summary.json"), 'w')
+            f.write(json.dumps(summary, indent=1))
+            f.close()
+        if "npz" in self.formats:
+            arrays = dict(b.arrays())
+            arrays.update(c.arrays())
+            np.savez(os.path.join(self.outfile, "Results.npz"), **arrays)
+        
+    def do_stream(self, arg):
+        """
+        stream Input Output [batchsize=1000]
+        Calculates the SOEC and TOEC of every material in an input file with many records (the single-file format repeated,
+        optionally each preceded by a comment line "#@ name"). The results are appended to Output/Constants.csv batch by batch.
+        """
+        arguments, options = self.arguments(arg, ["Input file:", self.outputprompt])
+        Stream(arguments[0], arguments[1], int(options.get("batchsize", 1000)))
+        
+    def do_watch(self, arg):
+        """
+        watch Campaign Output [interval=60 tolerance=0.001 patience=2 timeout=0]
+        Follows a campaign folder (the layout written by Matrices.py) while the VASP calculations finish. Every interval seconds the
+        finished calculations are added to the least square solution one by one, and the constants with their standard errors are
+        appended to Output/Watch.csv. It stops when every calculation is read, when no constant changed by more than tolerance
+        (relative) in patience polls in a row, or after timeout seconds (0 for no limit). If all calculations are read but they
+        do not determine all the constants, it stops with an error.
+        """
+        arguments, options = self.arguments(arg, ["Campaign folder:", self.outputprompt])
+        Watch(arguments[0], arguments[1], float(options.get("interval", 60)), float(options.get("tolerance", 0.001)),
+              int(options.get("patience", 2)), float(options.get("timeout", 0)))
+        
+    def do_design(self, arg):
+        """
+        design Output [volume=47.86 noise=0.001 strains=0.005:0.06:0.005 maxstrains=4 targets=C11:2,C456:5 criterion=D top=20
+                       maxstrain= truncation= layout=blocks tolerance=0.05 minstrains=3]
+        Plans a campaign before any calculation is made. Every set of up to maxstrains strains from the candidate strains
+        (a comma separated list or start:stop:step), with every subset of the deformations A1-A6 and with both signs or the
+        positive sign only, is rated by the standard errors of the constants it would give for an energy noise (eV, standard deviation).
+        The campaigns that meet the targets (standard errors in GPa) are ranked by their number of calculations and then by the
+        criterion: D (largest determinant of the information matrix) or A (smallest sum of variances). Output/Design.txt lists the best.
+        The noise alone always favours the largest strains, while the bias of the cubic expansion grows with the strain, so the candidate
+        strains are cut at maxstrain and at the largest safe strain that truncation finds in the input file given with truncation=
+        (e.g. a pilot calculation of the same material; layout, tolerance and minstrains as for truncation).
+        """
+        arguments, options = self.arguments(arg, [self.outputprompt])
+        targets = {}
+        for item in options["targets"].split(",") if options.get("targets") else []:
+            name, separator, value = item.partition(":")
+            if name not in Constants.names or not separator:
+                raise ValueError("Targets must be given as name:value with the names %s, got '%s'" %(", ".join(Constants.names), item))
+            targets[name] = float(value)
+        maxstrain = float(options["maxstrain"]) if options.get("maxstrain") else None
+        source = "maxstrain" if maxstrain is not None else None
+        if options.get("truncation"):
+            t = Truncation(options["truncation"], options.get("layout", "blocks"))
+            safest = t.check(float(options.get("tolerance", 0.05)), int(options.get("minstrains", 3)))
+            if safest is None:
+                raise ValueError("No strain range of %s is safe for the cubic expansion at the tolerance %g" %(options["truncation"], t.tolerance))
+            if maxstrain is None or safest < maxstrain:
+                maxstrain = safest
+                source = "the largest safe strain of %s" %options["truncation"]
+        a = Design(float(options.get("volume", 47.86)), float(options.get("noise", 0.001)), self.readstrains(options.get("strains", "0.005:0.06:0.005")),
+                   maxstrain, source)
+        a.search(int(options.get("maxstrains", 4)), targets, options.get("criterion", "D"))
+        a.store(os.path.join(arguments[0], "Design.txt"), int(options.get("top", 20)))
+        
+    def do_recommend(self, arg):
+        """
+        recommend Input Output [layout=blocks noise=0 strains=0.005:0.06:0.005 target=auto top=20]
+        Ranks the next calculations of a partial campaign (missing energies written as nan, or the long layout). Every candidate
+        calculation (deformation A1-A6, sign and strain from the candidate strains, and the missing calculations of the campaign) is rated
+        by how much it would reduce the variance of the target constant (auto: the one with the largest relative standard error), using
+        the covariance of the current fit. Calculations that determine constants that are still undetermined come first.
+        The noise of the energies (eV) is estimated from the residual of the fit unless given. Output/Recommend.txt lists the best.
+        """
+        arguments, options = self.arguments(arg, ["Input file:", self.outputprompt])
+        a = Recommend(arguments[0], options.get("layout", "blocks"), float(options.get("noise", 0)))
+        a.rank(self.readstrains(options.get("strains", "0.005:0.06:0.005")), options.get("target", "auto"))
+        a.store(os.path.join(arguments[1], "Recommend.txt"), int(options.get("top", 20)))
+        
+    def do_explore(self, arg):
+        """
+        explore Input Output [layout=blocks mode=windows,omit maxsize=2 minstrains=3 judge=C11,C12,C44,C111,C112,C123,C144,C166,C456 top=20]
+        Looks for the most reliable part of the data. The constants are fitted for every window of neighbouring strain values
+        (mode windows) and for all the data with every set of up to maxsize strain values omitted (mode omit),
+        as long as at least minstrains strain values are left.
+        Each fit is rated by its stability: the relative jackknife standard error (omitting one strain at a time within the fit)
+        of the constants to judge, combined as their root mean square. Output/Explore.txt lists the fits, the most stable first.
+        """
+        arguments, options = self.arguments(arg, ["Input file:", self.outputprompt])
+        judge = options["judge"].split(",") if "judge" in options else list(Constants.names)
+        for name in judge:
+            if name not in Constants.names:
+                raise ValueError("Unknown constant '%s', use %s" %(name, ", ".join(Constants.names)))
+        a = Explore(arguments[0], options.get("layout", "blocks"))
+        a.explore(options.get("mode", "windows,omit").split(","), int(options.get("maxsize", 2)), judge, int(options.get("minstrains", 3)))
+        a.store(os.path.join(arguments[1], "Explore.txt"), int(options.get("top", 20)))
+        
+    def do_truncation(self, arg):
+        """
+        truncation Input Output [layout=blocks tolerance=0.05 minstrains=3]
+        Fits the data up to every strain value twice: with the SOEC and TOEC only, and with fourth and fifth order terms added for each
+        deformation. The shift of every constant between the two fits shows how much of the higher order energy it absorbs. A largest strain
+        is safe when, up to it, no constant shifts by more than tolerance (relative) unless the shift is within two of its standard errors.
+        The shifts are written to Output/Truncation.txt.
+        """
+        arguments, options = self.arguments(arg, ["Input file:", self.outputprompt])
+        a = Truncation(arguments[0], options.get("layout", "blocks"))
+        a.check(float(options.get("tolerance", 0.05)), int(options.get("minstrains", 3)))
+        a.store(os.path.join(arguments[1], "Truncation.txt"))
+        
+    def do_montecarlo(self, arg):
+        """
+        montecarlo Input Output [layout=blocks noise=0 samples=10000 pressure=1 steps=1000 seed=]
+        Repeats the whole calculation for samples sets of energies perturbed by normal noise (eV, standard deviation; estimated from
+        the residual of the fit unless given). All the sets are solved and post-processed at once. Output/MonteCarlo.txt lists the
+        mean, standard deviation and percentiles of the constants and derived results, Output/MonteCarlo.npz holds all the samples.
+        """
+        arguments, options = self.arguments(arg, ["Input file:", self.outputprompt])
+        a = MonteCarlo(arguments[0], options.get("layout", "blocks"), float(options.get("noise", 0)), int(options.get("samples", 10000)),
+                       int(options["seed"]) if options.get("seed") else None)
+        a.sample()
+        a.propagate(float(options.get("pressure", 1)), int(options.get("steps", 1000)))
+        a.store(arguments[1])
+        
+    def do_synthetic(self, arg):
+        """
+        synthetic Output [constants=183.35,132.97,... volume=47.86 eqenergy=-15 strains=0.007:0.021:0.007 noise=0 quartic=0 quintic=0
+                          stressnoise=0 records=1 seed=]
+        Writes the energies that the constants (C11, C12, C44, C111, C112, C123, C144, C166, C456 in GPa) give for the strains to
+        Output/Synthetic.txt, in the form of example.txt, with normal noise (eV) and fourth and fifth order energy terms (GPa, one value
+        or six, one for each deformation) if given. Output/Stress.txt holds the stresses of the same calculations (for stress=).
+        With records above 1 that many noisy copies are written one after another, to be read by stream.
+        """
+        arguments, options = self.arguments(arg, [self.outputprompt])
+        numbers = lambda name, default: [float(x) for x in options[name].split(",")] if name in options else default
+        a = Synthetic(numbers("constants", Synthetic.reference), float(options.get("volume", 47.86)), float(options.get("eqenergy", -15.0)),
+                      self.readstrains(options.get("strains", "0.007:0.021:0.007")), numbers("quartic", 0), numbers("quintic", 0))
+        rng = np.random.default_rng(int(options["seed"]) if options.get("seed") else None)
+        records = int(options.get("records", 1))
+        a.write(os.path.join(arguments[0], "Synthetic.txt"), a.energies(float(options.get("noise", 0)), records if records > 1 else None, rng))
+        np.savetxt(os.path.join(arguments[0], "Stress.txt"), a.stresses(float(options.get("stressnoise", 0)), rng), fmt="%.17g",
+                   header="Cauchy stress xx yy zz yz xz xy in GPa, one calculation per line in the order of Synthetic.txt")
+        
+    def readstrains(self, text):
+        """Strains are given as a comma separated list or as start:stop:step (stop included)."""
+        if ":" in text:
+            start, stop, step = (float(x) for x in text.split(":"))
+            return np.round(np.arange(start, stop+step/2, step), 12)
+        return np.array([float(x) for x in text.split(",")])
+        
+    def do_replot(self, arg):
+        """
+        replot Output [name=value ...]
+        Regenerates the graphs from the Artifact.npz stored in the Output folder by a previous run with artifact=npz or artifact=mmap.
+        Nothing is recomputed, so the plot settings plotres, plots, planes, sectionres, mesh, cmap and title can be changed quickly.
+        """
+        arguments, options = self.arguments(arg, ["Output folder with the Artifact.npz:"], create=False)
+        Replot(arguments[0], **self.plotoptions(options))
+         
+    def plotoptions(self, options):
+        """Converts the optional settings that control the graphs and mesh exports into keyword arguments of PostProcess."""
+        return dict(plotres=int(options["plotres"]) if "plotres" in options else None,
+                    plots=options.get("plots", "3d").split(","),
+                    planes=options["planes"].split(",") if "planes" in options else (),
+                    sectionres=int(options.get("sectionres", 360)),
+                    mesh=options["mesh"].split(",") if "mesh" in options else (),
+                    cmap=options.get("cmap", "jet"),
+                    title=options.get("title", ""))
          
+    def arguments(self, arg, prompts, create=True):
+        """
+        Splits the argument line of a command into its positional arguments and its optional settings (readoptions).
+        When fewer positional arguments are given, each is asked for with its prompt. The last one is the output folder,
+        which is created if it does not exist (unless create is False).
+        """
+        arguments = shlex.split(arg)
+        if len(arguments) < len(prompts):
+            arguments = [input(prompt) for prompt in prompts]
+        positional = arguments[:len(prompts)]
+        if create and positional[-1]!="":
+            if not os.path.exists(positional[-1]):
+                os.makedirs(positional[-1])
+        return positional, self.readoptions(arguments[len(prompts):])
+        
+    def readoptions(self, arguments):
+        """
+        Optional settings follow the five positional arguments in the form name=value, e.g. plotres=150.
+        Returns a dictionary of the settings as strings, the conversion is left to the place where they are used.
+        """
+        options = {}
+        for argument in arguments:
+            name, separator, value = argument.partition("=")
+            if not separator:
+                raise ValueError("Optional settings must be given as name=value, got '%s'" %argument)
+            options[name] = value
+        return options
+        
         
 class Calculate(Cmd):
     """This Class needs to be called with arguments:inputfilename, outputfilename, method to use.\
@@ -75,38 +347,52 @@ class Calculate(Cmd):
     This is a good check of consistency of results and thus the reliability of data and script."""
 
 
-    def __init__(self,  inp, outpath):
+    def __init__(self,  inp, outpath, formats=(), layout="blocks", stress=None, diagnostics=False):
         self.input = inp
         self.outpath = outpath
-        self.data =  np.genfromtxt(self.input+".txt", dtype=float, comments="#")
+        self.formats = list(formats)
+        self.diagnostics = diagnostics
+        self.layout = layout
+        self.parser = Parser(self.input+".txt")
+        self.parser.readlayout(self.layout)
+        self.data = self.parser.data
+        # the stresses of the calculations, in the order of the energies, are fitted together with them
+        self.stress = Parser(stress).readstress(len(self.parser.energies)) if stress else None
         self.calc()
-        self.ndeltas = self.data[0]
+        self.ndeltas = self.parser.ndeltas
+        self.loo = np.zeros((0, 9))
+        self.looresidual = np.zeros(0)
         if self.ndeltas>1:
             self.leaveone() 
+        if "csv" in self.formats:
+            self.storecsv()
                       
 
     def calc(self):
         """calculates the elastic constants from the input values of energy.\
         Uses the Script class which uses the least square method to find a solution to set of equations with 9 unknowns.\
         It creates a file with the constants and the residual, which is a good measure of reliability"""
-        self.ndeltas = self.data[0]                         
-        self.volume = self.data[1]
-        self.eqenergy = self.data[2]
-        n=int(self.data[0])
-        # Rework the value of strain into needed form.
-        i = 0        
-        self.delt = [0.0]*n
-        for i in range (0, n):                 
-            self.delt[i] = self.data[i+3]
-                 
-        # Energies are prepared for the input format.    
-        self.values = [0.0]*((n)*12) #the list to which energies will be stored         
-        # inports all the energy values and save them into self.values:      
-        for j in range(0, len(self.data) -3-n ):          
-            self.values[j] = self.data[j +3+n]
+        self.ndeltas = self.parser.ndeltas
+        self.volume = self.parser.volume
+        self.eqenergy = self.parser.eqenergy
+        # The strains and energies are views into the parsed data, they are used directly as input.
+        self.delt = self.parser.deltas
+        self.values = self.parser.energies
                 
         a = Constants(self.ndeltas, self.volume, self.eqenergy,self.delt, self.values )        
-        self.constants, self.residual = a.solve()
+        if self.layout == "long" and self.stress is not None:
+            self.constants, self.residual = a.joint(self.parser.deformation, self.parser.strain, self.values, self.stress)
+        elif self.layout == "long":
+            self.constants, self.residual = a.fit(self.parser.deformation, self.parser.strain, self.values)
+        else:
+            self.constants, self.residual = a.solve(self.stress)
+        self.covariance = a.covariance
+        self.note = a.note()
+        if self.note:
+            print(self.note)
+        if self.diagnostics:
+            a.storeinfluence(os.path.join(self.outpath, "Influence.txt"))
+            a.storeresiduals(os.path.join(self.outpath, "Residuals.txt"))
         
         #Storing algorithm
         self.completeName = os.path.join(self.outpath, "Constants.txt")
@@ -118,6 +404,8 @@ class Calculate(Cmd):
             f.write("\n")
             
         f.write(str(self.residual))
+        if self.note:
+            f.write("\n# "+self.note)
         f.close()
                 
     def leaveone(self):
@@ -130,39 +418,33 @@ class Calculate(Cmd):
         self.completeName2 = os.path.join(self.outpath, "LeaveOneOut.txt")  
         f2 = open(self.completeName2, 'w') # creates an output file
         # Prepares all the data for input into solving script
-        self.n = int(self.data[0])
-        self.volume = self.data[1]
-        self.eqenergy = self.data[2]
-        self.deltas = self.data[3:self.n+3]
-        self.energy = self.data[self.n+3:]
-        self.values = np.array([0.0]*(int(self.n-1)*12))
-        self.delt = np.array([0.0]*(int(self.n-1)))   
+        self.n = self.parser.ndeltas
+        self.volume = self.parser.volume
+        self.eqenergy = self.parser.eqenergy
+        self.deltas = self.parser.deltas
+        self.energy = self.parser.energies
         
-        # THe main "i" loop is responsible for omitting one set of data each time.
-        #This is done through integers being compared to the intiger on the values being sorted  
+        # The main "i" loop is responsible for omitting one set of data each time.
         # It also stores the values each time they are calculated.
-        #The "k" loop is for sorting value of strains 
-        #The "j" loop is for sorting the energy values
+        self.loo = np.zeros((int(self.n), 9))
+        self.looresidual = np.zeros(int(self.n))
         for i in range(0, int(self.n)):
-            j=0
-            help2=0
-            help=0
-            # These help intigers are used to get rid of a line full of zeros.
-            #E.g. after omitting one set of data the next is safed into the place of the previous one, instead of leaving a blank space
-  
-            for k in range(0, int(self.n)):
-                if k!= i:
-                    self.delt[k-help] = self.deltas[k]
+            if self.layout == "long":
+                # all the energies with this strain are omitted, whatever their deformation
+                keep = abs(self.parser.strain) != self.deltas[i]
+                a = Constants(volume=self.volume, eqenergy=self.eqenergy)
+                if self.stress is not None:
+                    self.results, residual = a.joint(self.parser.deformation[keep], self.parser.strain[keep], self.energy[keep], self.stress[keep])
                 else:
-                    help=1 
-            for j in range (0,  int(self.n*12)):
-                if int(j/12)!= i:
-                    self.values[j-help2] = self.energy[j]
-                else:
-                    help2=12
-               
-            a = Constants((self.n-1), self.volume, self.eqenergy,self.delt, self.values )
-            self.results, residual = a.solve()
+                    self.results, residual = a.fit(self.parser.deformation[keep], self.parser.strain[keep], self.energy[keep])
+            else:
+                self.delt = np.delete(self.deltas, i)
+                self.values = np.delete(self.energy, np.s_[12*i:12*(i+1)])
+                   
+                a = Constants((self.n-1), self.volume, self.eqenergy,self.delt, self.values )
+                self.results, residual = a.solve(None if self.stress is None else np.delete(self.stress, np.s_[12*i:12*(i+1)], axis=0))
+            self.loo[i] = self.results
+            self.looresidual[i] = self.scalar(residual)
                
             f2.write("when the set number %d was omitted the following data was obtained\n" %i)
             constants = ["  #C11 in GPa","  #C12 in GPa", "  #C44 in GPa", "  #C111 in GPa", "  #C112 in GPa", "  #C123 in GPa", "  #C144 in GPa","  #C166 in GPa", "  #C456 in GPa"]
@@ -173,12 +455,952 @@ class Calculate(Cmd):
             f2.write(str(residual))
             f2.write(" # residuals\n")
             f2.write("\n") 
+        f2.close()
+            
+    def scalar(self, residual):
+        """The residual of lstsq is an array with one value, or empty when the system is not overdetermined (then NaN is used)."""
+        return float(residual[0]) if len(residual) else float("nan")
+            
+    def storecsv(self):
+        """Stores the constants and the leave-one-out sets as csv tables in full precision, each with one savetxt."""
+        header = ",".join(Constants.names)+",residual"
+        np.savetxt(os.path.join(self.outpath, "Constants.csv"), np.append(self.constants, self.scalar(self.residual))[None],
+                   fmt="%.17g", delimiter=",", header=header, comments="")
+        np.savetxt(os.path.join(self.outpath, "LeaveOneOut.csv"),
+                   np.column_stack([np.arange(len(self.loo)), self.parser.deltas[:len(self.loo)], self.loo, self.looresidual]),
+                   fmt=["%d", "%.17g"]+["%.17g"]*10, delimiter=",", header="omitted,delta,"+header, comments="")
+            
+    def summary(self):
+        """Returns the constants, residual and leave-one-out sets as a dictionary for Summary.json."""
+        return dict(volume=float(self.parser.volume), eqenergy=float(self.parser.eqenergy), deltas=self.parser.deltas.tolist(),
+                    constants=dict(zip(Constants.names, self.constants.tolist())), residual=self.scalar(self.residual),
+                    leaveoneout=[dict(omitted=i, delta=float(self.parser.deltas[i]), residual=float(self.looresidual[i]),
+                                      constants=dict(zip(Constants.names, self.loo[i].tolist()))) for i in range(len(self.loo))])
+            
+    def arrays(self):
+        """Returns the input and results as arrays for Results.npz."""
+        return dict(deltas=self.parser.deltas, energies=self.parser.energies, constants=self.constants,
+                    residual=np.array(self.scalar(self.residual)), leaveoneout=self.loo, leaveoneoutresidual=self.looresidual)
+  
+class Stream:
+    """
+    This class calculates the SOEC and TOEC for an input file with many materials (records, see the records method of Parser).
+    The records are read lazily and solved in batches: all records of a batch with the same strain values share the matrix A,
+    so they are solved by one least square call with many right sides. The results are appended to Constants.csv after every batch,
+    so the memory use does not depend on the number of materials in the file.
+    """
+    def __init__(self, inp, outpath, batchsize=1000):
+        self.input = inp
+        self.outpath = outpath
+        self.batchsize = batchsize
+        self.count = 0
+        
+        self.completeName = os.path.join(self.outpath, "Constants.csv")
+        f = open(self.completeName, 'w')
+        f.write("material,%s,residual\n" %",".join(Constants.names))
+        batch = []
+        for record in Parser(self.input+".txt").records():
+            batch.append(record)
+            if len(batch) == self.batchsize:
+                self.solve(batch, f)
+                batch = []
+        if batch:
+            self.solve(batch, f)
+        f.close()
+        
+    def solve(self, batch, f):
+        """Solves one batch of records and writes their results to the open file f in the order of the input."""
+        results = [None]*len(batch)
+        groups = {}
+        for i, record in enumerate(batch):
+            # records with the same strains and the same missing (NaN) energies share the matrix A
+            groups.setdefault(record.deltas.tobytes()+np.isnan(record.energies).tobytes(), []).append(i)
+        for members in groups.values():
+            a = Constants(batch[members[0]].ndeltas, delta=batch[members[0]].deltas)
+            deformation, strain = a.layout(a.delta)
+            known = np.isfinite(batch[members[0]].energies)
+            deformation, strain = deformation[known], strain[known]
+            energies = np.array([batch[i].energies[known] for i in members]).T
+            volumes = np.array([batch[i].volume for i in members])
+            eqenergies = np.array([batch[i].eqenergy for i in members])
+            # the same as Constants.density, with the determinants calculated once for the whole group
+            b = (energies-eqenergies)*(a.eVA3/a.determinants(deformation, strain))[:, None]/volumes
+            rows = a.rows(deformation, strain)
+            x, residues, rank, sv = np.linalg.lstsq(rows, b, rcond=None)
+            x[~a.identifiable(rows)] = np.nan
+            if len(residues) == 0:
+                residues = np.full(len(members), np.nan)
+            for column, i in enumerate(members):
+                results[i] = np.append(x[:, column], residues[column])
+                
+        lines = ["%s,%s" %(record.name.replace(",", " "), ",".join("%.17g" %value for value in result)) for record, result in zip(batch, results)]
+        f.write("\n".join(lines)+"\n")
+        f.flush()
+        self.count += len(batch)
   
+class Incremental:
+    """
+    This class solves the least square problem of Constants one energy at a time, for results that arrive over time.
+    Instead of the matrix A it keeps the triangular factor R of its QR decomposition, Q^T B and the sum of squared residuals.
+    A new row is folded into R by Givens rotations, which costs only a number of operations proportional to 9*9,
+    and the constants are found by back substitution at any moment. The result is the same as the least square solution of all the rows.
+    """
+    def __init__(self, volume, eqenergy):
+        self.constants = Constants(volume=volume, eqenergy=eqenergy)
+        self.R = np.zeros((9, 9))
+        self.z = np.zeros(9)
+        self.rss = 0.0
+        self.count = 0
+        
+    def add(self, deformation, strain, energy):
+        """Adds the energy of deformation (0 for A1 ... 5 for A6) with the signed strain."""
+        row = self.constants.rows(np.array([deformation]), np.array([strain]))[0]
+        b = self.constants.density(np.array([energy]), np.array([deformation]), np.array([strain]))[0]
+        for k in range(9):
+            if row[k] == 0.0:
+                continue
+            r = math.hypot(self.R[k, k], row[k])
+            c, s = self.R[k, k]/r, row[k]/r
+            Rk = self.R[k, k:].copy()
+            self.R[k, k:] = c*Rk + s*row[k:]
+            row[k:] = -s*Rk + c*row[k:]
+            self.z[k], b = c*self.z[k] + s*b, -s*self.z[k] + c*b
+        self.rss += b*b
+        self.count += 1
+        
+    def rank(self):
+        """Number of constants that are determined by the energies added so far."""
+        diagonal = abs(np.diag(self.R))
+        return int(np.sum(diagonal > 1e-12*max(diagonal.max(), 1e-300)))
+        
+    def solve(self):
+        """Returns the constants, their standard errors (NaN while there are no more energies than constants) and the residual."""
+        if self.rank() < 9:
+            raise ValueError("The %d energies do not determine all 9 constants yet" %self.count)
+        x = np.linalg.solve(self.R, self.z)
+        if self.count > 9:
+            Rinv = np.linalg.inv(self.R)
+            errors = np.sqrt(self.rss/(self.count-9)*np.sum(Rinv**2, axis=1))
+        else:
+            errors = np.full(9, np.nan)
+        return x, errors, self.rss
+        
+        
+class Watch:
+    """
+    This class follows a campaign folder while its calculations finish and updates the constants with Incremental:
+        reference/                  the calculation at zero strain (equilibrium energy and volume)
+        strain_0.007/A1_pos/        one folder for every strain and deformation A1...A6 with positive (pos)
+        strain_0.007/A1_neg/        and negative (neg) strain, each with an OUTCAR or vasprun.xml
+    A calculation counts as finished when its OUTCAR has the final timing or its vasprun.xml is closed; the results are read
+    by Run of DFT_ingestion/Ingest.py, the same reader that writes the input file when the campaign is done. Ingest.py is only
+    loaded when a campaign is watched, so the other tasks do not need the DFT_ingestion folder.
+    Only the folders that exist are watched, so a campaign in which some calculations are left out (layout=long) ends as well.
+    Every poll that finds new results appends the constants and their standard errors to Watch.csv.
+    """
+    names = ("A1", "A2", "A3", "A4", "A5", "A6")
+    
+    def __init__(self, campaign, outpath, interval=60, tolerance=0.001, patience=2, timeout=0):
+        self.campaign = campaign
+        self.outpath = outpath
+        self.interval = interval
+        self.tolerance = tolerance
+        self.patience = patience
+        self.timeout = timeout
+        self.read = set()
+        self.solver = None
+        self.previous = None
+        self.stable = 0
+        self.start = time.time()
+        self.Run = self.reader()
+        
+        self.completeName = os.path.join(self.outpath, "Watch.csv")
+        f = open(self.completeName, 'w')
+        f.write("time,energies,%s,%s,residual\n" %(",".join(Constants.names), ",".join("d"+name for name in Constants.names)))
+        while True:
+            pending = self.poll(f)
+            if self.stable >= self.patience:
+                print("The constants converged, the remaining calculations are not needed")
+                break
+            if self.solver is not None and pending == 0:
+                if self.solver.rank() < 9:
+                    f.close()
+                    raise ValueError("All %d calculations are read, but they determine only %d of the 9 constants"
+                                     %(self.solver.count, self.solver.rank()))
+                print("All calculations are read")
+                break
+            if self.timeout and time.time()-self.start > self.timeout:
+                print("Stopped after %g s" %self.timeout)
+                break
+            time.sleep(self.interval)
+        f.close()
+        
+    @staticmethod
+    def reader():
+        """Loads Run from DFT_ingestion/Ingest.py by its path, without adding the folder to sys.path."""
+        import importlib.util
+        filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "DFT_ingestion", "Ingest.py")
+        if not os.path.isfile(filename):
+            raise FileNotFoundError("watch reads the calculations with %s, which is missing" %os.path.normpath(filename))
+        spec = importlib.util.spec_from_file_location("Ingest", filename)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module.Run
+        
+    def runs(self):
+        """Returns the deformation index, signed strain and folder of every calculation found in the campaign."""
+        runs = []
+        for entry in os.scandir(self.campaign):
+            if entry.is_dir() and entry.name.startswith("strain_"):
+                delta = float(entry.name[len("strain_"):])
+                for k, name in enumerate(self.names):
+                    for sign, suffix in ((1.0, "pos"), (-1.0, "neg")):
+                        folder = os.path.join(entry.path, "%s_%s" %(name, suffix))
+                        if os.path.isdir(folder):
+                            runs.append((k, sign*delta, folder))
+        return sorted(runs, key=lambda run: (abs(run[1]), run[0], -run[1]))
+        
+    def poll(self, f):
+        """Adds all newly finished calculations, writes the update and returns the number of calculations still pending."""
+        if self.solver is None:
+            reference = self.Run(os.path.join(self.campaign, "reference")).result(volume=True)
+            if reference is None:
+                return -1
+            self.solver = Incremental(reference[1], reference[0])
+        pending = 0
+        added = 0
+        for deformation, strain, folder in self.runs():
+            if folder in self.read:
+                continue
+            result = self.Run(folder).result()
+            if result is None:
+                pending += 1
+                continue
+            self.solver.add(deformation, strain, result[0])
+            self.read.add(folder)
+            added += 1
+        if added and self.solver.rank() == 9:
+            x, errors, rss = self.solver.solve()
+            f.write("%.3f,%d,%s,%s,%.17g\n" %(time.time()-self.start, self.solver.count, ",".join("%.17g" %v for v in x),
+                                                ",".join("%.17g" %v for v in errors), rss))
+            f.flush()
+            print("%d energies: %s" %(self.solver.count, ", ".join("%s=%.2f(%.2f)" %item for item in zip(Constants.names, x, errors))), flush=True)
+            if self.previous is not None and np.all(abs(x-self.previous) <= self.tolerance*abs(x)):
+                self.stable += 1
+            else:
+                self.stable = 0
+            self.previous = x
+        return pending
+        
+        
+class Design:
+    """
+    This class rates possible campaigns (sets of strains, deformations and signs) before they are calculated.
+    For an energy noise sigma (eV) the right side B of a deformation with strain e has the noise sigma*eVA3/(V*det), so every
+    calculation adds its row of A, weighted by the inverse of that variance, to the information matrix M = A^T W A of the fit.
+    The covariance of the constants is the inverse of M. The information matrices of single calculations (strain, deformation, sign)
+    are computed once, those of all candidate campaigns are sums of them found with matrix products,
+    and the determinants and inverses of all candidates are calculated at once.
+    The errors hold the noise only. The bias of the truncated (cubic) expansion grows with the strain, so the candidate strains
+    are cut at maxstrain (e.g. the largest safe strain found by Truncation).
+    """
+    def __init__(self, volume, noise, strains, maxstrain=None, source=None):
+        self.volume = volume
+        self.noise = noise
+        self.strains = np.asarray(strains, dtype=float)
+        self.maxstrain = maxstrain
+        self.source = source or "maxstrain"
+        if maxstrain is not None:
+            self.strains = self.strains[self.strains <= maxstrain*(1+1e-9)]
+            if len(self.strains) == 0:
+                raise ValueError("None of the candidate strains is within the largest strain %g (%s)" %(maxstrain, self.source))
+        self.constants = Constants(volume=volume)
+        # deformation index and signed strain of every single calculation, in the order (strain, deformation, sign)
+        deformation = np.tile(np.repeat(np.arange(6), 2), len(self.strains))
+        strain = np.repeat(self.strains, 12)*np.tile([1.0, -1.0], 6*len(self.strains))
+        rows = self.constants.rows(deformation, strain)
+        weight = 1/self.constants.variances(deformation, strain, noise)
+        self.blocks = (weight[:, None, None]*rows[:, :, None]*rows[:, None, :]).reshape(len(self.strains), 12, 81)
+        
+    def search(self, maxstrains, targets={}, criterion="D"):
+        """Rates all candidate campaigns and sorts them: those meeting the targets first, then by cost and criterion."""
+        if criterion not in ("D", "A"):
+            raise ValueError("Unknown criterion '%s', use D or A" %criterion)
+        n = len(self.strains)
+        subsets = [c for k in range(1, min(maxstrains, n)+1) for c in itertools.combinations(range(n), k)]
+        strainmask = np.zeros((len(subsets), n))
+        for i, subset in enumerate(subsets):
+            strainmask[i, list(subset)] = 1.0
+        # every subset of the six deformations, with both signs or the positive sign only
+        choices = [(deformations, signs) for deformations in range(1, 64) for signs in ((1.0, 1.0), (1.0, 0.0))]
+        calcmask = np.array([[((deformations >> k) & 1)*signs[g] for k in range(6) for g in range(2)] for deformations, signs in choices])
+        perstrain = np.einsum('cs,skf->ckf', strainmask, self.blocks)
+        M = np.einsum('ckf,mk->cmf', perstrain, calcmask).reshape(-1, 9, 9)
+        cost = (strainmask.sum(axis=1)[:, None]*calcmask.sum(axis=1)[None, :]).ravel()
+        
+        sign, logdet = np.linalg.slogdet(M)
+        # only campaigns that determine all nine constants are kept: the information matrix scaled to unit diagonal must not be singular
+        diagonal = np.einsum('cii->ci', M)
+        scale = 1/np.sqrt(np.where(diagonal > 0, diagonal, np.inf))
+        smallest = np.linalg.eigvalsh(M*scale[:, :, None]*scale[:, None, :])[:, 0]
+        valid = (sign > 0) & (smallest > 1e-10)
+        M, cost, logdet = M[valid], cost[valid], logdet[valid]
+        index = np.flatnonzero(valid)
+        errors = np.sqrt(np.einsum('cii->ci', np.linalg.inv(M)))
+        target = np.array([targets.get(name, np.inf) for name in Constants.names])
+        meets = np.all(errors <= target, axis=1)
+        score = -logdet if criterion == "D" else np.sum(errors**2, axis=1)
+        order = np.lexsort((score, cost, ~meets))
+        
+        self.candidates = len(valid)
+        self.targets = targets
+        self.criterion = criterion
+        self.results = [dict(strains=self.strains[list(subsets[i//len(choices)])], deformations=choices[i%len(choices)][0],
+                             positive=choices[i%len(choices)][1][1] == 0.0, cost=int(cost[j]), logdet=logdet[j], errors=errors[j], meets=bool(meets[j]))
+                        for j, i in ((j, index[j]) for j in order)]
+        return self.results
+        
+    def describe(self, result):
+        """Returns a campaign as one line of text."""
+        deformations = ",".join("A%d" %(k+1) for k in range(6) if (result["deformations"] >> k) & 1)
+        return "%4d calculations: strains %s, %s, %s signs, log det %.2f, standard errors %s" %(
+            result["cost"], ",".join("%g" %e for e in result["strains"]), deformations, "positive" if result["positive"] else "both",
+            result["logdet"], ", ".join("%s=%.3g" %item for item in zip(Constants.names, result["errors"])))
+        
+    def store(self, filename, top=20):
+        """Writes the best campaigns to the file and prints the cheapest one that meets the targets."""
+        lines = ["# %d candidate campaigns from strains %s, energy noise %g eV, volume %g A^3, criterion %s" %(
+                     self.candidates, ",".join("%g" %e for e in self.strains), self.noise, self.volume, self.criterion),
+                 "# targets (GPa): %s" %(", ".join("%s=%g" %item for item in self.targets.items()) or "none"),
+                 "# largest strain: %s" %("%g (%s)" %(self.maxstrain, self.source) if self.maxstrain is not None
+                                          else "not limited, the truncation bias of the largest strains is not rated")]
+        lines.extend(("" if result["meets"] else "(misses targets) ")+self.describe(result) for result in self.results[:top])
+        f = open(filename, 'w')
+        f.write("\n".join(lines)+"\n")
+        f.close()
+        if self.results and self.results[0]["meets"]:
+            print("Cheapest campaign: "+self.describe(self.results[0]))
+        else:
+            print("No campaign meets the targets, the best are listed in %s" %filename)
+        if self.results and self.maxstrain is None:
+            print("Warning: the errors hold the noise only, check that the largest strain %g is safe for the cubic expansion "
+                  "(truncation, or give design truncation= or maxstrain=)" %max(self.results[0]["strains"]))
+        
+        
+class Recommend:
+    """
+    This class ranks the single calculations that would help a partial campaign the most.
+    The right side B of a calculation has the variance s^2 = (sigma*eVA3/(V*det))^2 for the energy noise sigma (Constants.variances,
+    the same weighting as in Design), so the covariance of the constants is C = (A^T W A)^-1 with W = diag(1/s^2).
+    Adding one calculation with the row a changes it by a rank-one update (Sherman-Morrison):
+        C' = C - (C a)(C a)^T / (s^2 + a^T C a)
+    so the variance of constant j drops by (C a)_j^2 / (s^2 + a^T C a). This is evaluated for all candidates at once.
+    The candidates are the strains given and the calculations of the campaign itself whose energies are still missing.
+    While some constants are not determined yet, the candidates that make the most of them determinable come first: the part of a in
+    the null space N of A removes one direction from it, and constant j becomes determined when no direction is left that changes it.
+    """
+    def __init__(self, inp, layout="blocks", noise=0):
+        self.input = inp
+        self.parser = Parser(self.input+".txt")
+        self.deformation, self.strain, energies = self.parser.readlayout(layout)
+        self.constants = Constants(volume=self.parser.volume, eqenergy=self.parser.eqenergy)
+        self.x, residual = self.constants.fit(self.deformation, self.strain, energies)
+        self.A = self.constants.rows(self.deformation, self.strain)
+        a, b = self.constants.weighted(self.deformation, self.strain, energies)
+        self.identified = self.constants.identifiable(a)
+        self.constants.covariancematrix(a, b, np.linalg.lstsq(a, b, rcond=None)[0])
+        if noise > 0:
+            self.variance = noise**2
+            self.noise = "%g eV (given)" %noise
+        elif self.constants.dof > 0:
+            self.variance = self.constants.variance
+            self.noise = "%g eV (from the residual)" %np.sqrt(self.variance)
+        else:
+            raise ValueError("The noise cannot be estimated from %d energies, give it with noise=" %len(self.A))
+        self.null = self.constants.vt[self.constants.rank:]
+        self.covariance = self.variance*self.constants.unscaled
+        self.errors = np.where(self.identified, np.sqrt(np.diag(self.covariance)), np.nan)
+        
+    def rank(self, strains, target="auto"):
+        """
+        Rates every candidate (deformation, sign, strain) not calculated yet, from the strains and the missing energies of the campaign,
+        and sorts them: those that determine the most undetermined constants first, then by the variance reduction of the target.
+        """
+        if target == "auto":
+            relative = np.where(self.identified, self.errors/abs(self.x), -np.inf)
+            target = Constants.names[int(np.argmax(relative))]
+        if target not in Constants.names:
+            raise ValueError("Unknown constant '%s', use auto or one of %s" %(target, ", ".join(Constants.names)))
+        self.target = target
+        j = Constants.names.index(target)
+        strains = np.asarray(strains, dtype=float)
+        missing = ~self.parser.known
+        deformation = np.concatenate([self.parser.deformation[missing], np.repeat(np.arange(6), 2*len(strains))])
+        strain = np.concatenate([self.parser.strain[missing], np.tile(np.concatenate([strains, -strains]), 6)])
+        seen = set(zip(self.deformation.tolist(), np.round(self.strain, 12).tolist()))
+        new = np.zeros(len(deformation), dtype=bool)
+        for i, key in enumerate(zip(deformation.tolist(), np.round(strain, 12).tolist())):
+            new[i] = key not in seen
+            seen.add(key)
+        self.deformation_c, self.strain_c = deformation[new], strain[new]
+        self.missing_c = (np.arange(len(deformation)) < missing.sum())[new]
+        a = self.constants.rows(self.deformation_c, self.strain_c)
+        
+        # part of each candidate that lies in the null space (nonzero only while constants are undetermined)
+        c = a @ self.null.T
+        self.newinfo = np.sqrt(np.sum(c**2, axis=1))/np.sqrt(np.sum(a**2, axis=1))
+        # constants determined by each candidate: what is left of their null space columns once the direction c is removed
+        inside = np.where(self.newinfo > 1e-8, 1/np.maximum(np.sum(c**2, axis=1), np.finfo(float).tiny), 0)
+        left = np.sum(self.null**2, axis=0)[None, :] - (c @ self.null)**2*inside[:, None]
+        self.determines = (np.sqrt(np.maximum(left, 0)) < 1e-6) & ~self.identified
+        Ca = a @ self.covariance
+        variance = self.constants.variances(self.deformation_c, self.strain_c, np.sqrt(self.variance))
+        denominator = variance + np.sum(Ca*a, axis=1)
+        self.reduction = Ca[:, j]**2/denominator
+        self.dgain = 0.5*np.log1p(np.sum(Ca*a, axis=1)/variance)
+        if self.identified[j]:
+            self.newerror = np.sqrt(np.maximum(self.errors[j]**2-self.reduction, 0))
+        else:
+            self.newerror = np.full(len(a), np.nan)
+        newinfo = np.where(self.newinfo > 1e-8, self.newinfo, 0)
+        self.order = np.lexsort((-self.dgain, -self.reduction, -newinfo, -self.determines.sum(axis=1)))
+        return self.order
+        
+    def store(self, filename, top=20):
+        """Writes the ranked candidates to the file and prints the best ones."""
+        j = Constants.names.index(self.target)
+        lines = ["# %d energies used, noise %s, target %s = %.6g +- %.3g GPa" %(len(self.A), self.noise, self.target, self.x[j], self.errors[j]),
+                 "# current standard errors: %s" %", ".join("%s=%.3g" %item for item in zip(Constants.names, self.errors)),
+                 "# deformation, strain, new standard error of %s, variance reduction in %%, information gain (log det / 2), new direction, "
+                 "constants it determines, missing in the campaign" %self.target]
+        for i in self.order[:top]:
+            lines.append("A%d %+.6g %.4g %.2f %.4f %.3g %s %s" %(self.deformation_c[i]+1, self.strain_c[i], self.newerror[i],
+                                                                 100*self.reduction[i]/self.errors[j]**2 if self.errors[j] > 0 else float("nan"),
+                                                                 self.dgain[i], self.newinfo[i],
+                                                                 ",".join(np.array(Constants.names)[self.determines[i]]) or "-",
+                                                                 "yes" if self.missing_c[i] else "no"))
+        f = open(filename, 'w')
+        f.write("\n".join(lines)+"\n")
+        f.close()
+        print("\n".join(lines[:2]+lines[2:8]))
+        
+        
+class Explore:
+    """
+    This class fits many subsets of the strain values at once. For every strain value the blocks A^T A (9x9), A^T B and B^T B
+    of its energies are computed once; the normal equations of any subset of strains are then sums of these blocks,
+    found for all subsets by one matrix product. Each fit is rated by the jackknife over its own strains (again by subtracting blocks),
+    so thousands of fits take milliseconds. The columns are scaled to unit diagonal before solving, as the quadratic and
+    cubic columns differ by the strain in size. With higher the twelve columns of Constants.higher are added after the constants.
+    """
+    def __init__(self, inp, layout="blocks", higher=False):
+        self.input = inp
+        self.parser = Parser(self.input+".txt")
+        deformation, strain, energies = self.parser.readlayout(layout)
+        constants = Constants(volume=self.parser.volume, eqenergy=self.parser.eqenergy)
+        A = constants.rows(deformation, strain)
+        if higher:
+            A = np.hstack([A, constants.higher(deformation, strain)])
+        self.p = A.shape[1]
+        b = constants.density(energies, deformation, strain)
+        self.strains, group = np.unique(abs(strain), return_inverse=True)
+        onehot = np.zeros((len(strain), len(self.strains)))
+        onehot[np.arange(len(strain)), group] = 1.0
+        self.G = np.einsum('rn,ri,rj->nij', onehot, A, A).reshape(len(self.strains), self.p*self.p)
+        self.h = np.einsum('rn,ri->ni', onehot, A*b[:, None])
+        self.c = onehot.T @ b**2
+        self.count = onehot.sum(axis=0)
+        
+    def solve(self, masks):
+        """
+        Returns the constants, the residual sum of squares, the rank test and the diagonal of (A^T A)^-1 (the variances of the
+        constants for unit noise) for the subsets given as 0/1 masks of the strains.
+        """
+        M = (masks @ self.G).reshape(-1, self.p, self.p)
+        h = masks @ self.h
+        c = masks @ self.c
+        diagonal = np.einsum('mii->mi', M)
+        scale = 1/np.sqrt(np.where(diagonal > 0, diagonal, np.inf))
+        Ms = M*scale[:, :, None]*scale[:, None, :]
+        valid = np.linalg.eigvalsh(Ms)[:, 0] > 1e-12
+        Ms[~valid] = np.eye(self.p)
+        inverse = np.linalg.inv(Ms)
+        x = np.einsum('mij,mj->mi', inverse, h*scale)*scale
+        rss = c - 2*np.sum(x*h, axis=1) + np.einsum('mi,mij,mj->m', x, M, x)
+        x[~valid] = np.nan
+        return x, np.maximum(rss, 0), valid, np.einsum('mii->mi', inverse)*scale**2
+        
+    def explore(self, modes=("windows", "omit"), maxsize=2, judge=None, minstrains=3):
+        """Fits all windows and omitted sets and rates them by their jackknife stability (of all constants if judge is None)."""
+        judge = list(Constants.names) if judge is None else judge
+        n = len(self.strains)
+        subsets = []
+        for mode in modes:
+            if mode == "windows":
+                subsets.extend(("window", tuple(range(i, j))) for i in range(n) for j in range(i+max(minstrains, 2), n+1))
+            elif mode == "omit":
+                subsets.extend(("omit", tuple(k for k in range(n) if k not in omitted))
+                               for size in range(0, maxsize+1) for omitted in itertools.combinations(range(n), size) if n-size >= max(minstrains, 2))
+            else:
+                raise ValueError("Unknown mode '%s', use windows or omit" %mode)
+        masks = np.zeros((len(subsets), n))
+        for i, (kind, subset) in enumerate(subsets):
+            masks[i, list(subset)] = 1.0
+        x, rss, valid, variance = self.solve(masks)
+        
+        # jackknife: every fit again with each of its strains left out
+        jackmasks = masks[:, None, :]*(1-np.eye(n))[None, :, :]
+        xj, rssj, validj, variancej = self.solve(jackmasks.reshape(-1, n))
+        xj = xj.reshape(len(subsets), n, 9)
+        inside = masks.astype(bool) & validj.reshape(len(subsets), n)
+        m = inside.sum(axis=1)
+        mean = np.nansum(np.where(inside[:, :, None], xj, 0), axis=1)/np.maximum(m, 1)[:, None]
+        spread = np.sum(np.where(inside[:, :, None], (xj-mean[:, None, :])**2, 0), axis=1)
+        jackknife = np.sqrt((m-1)/np.maximum(m, 1)*spread.T).T
+        columns = [Constants.names.index(name) for name in judge]
+        relative = jackknife[:, columns]/abs(x[:, columns])
+        self.score = np.where(valid & (m == masks.sum(axis=1)), np.sqrt(np.mean(relative**2, axis=1)), np.inf)
+        energies = masks @ self.count
+        self.noise = np.sqrt(rss/np.maximum(energies-9, 1))
+        
+        self.subsets, self.masks, self.x, self.jackknife, self.judge = subsets, masks, x, jackknife, judge
+        self.order = np.argsort(self.score, kind="stable")
+        return self.order
+        
+    def describe(self, i):
+        kind, subset = self.subsets[i]
+        if kind == "window":
+            text = "window %g-%g" %(self.strains[subset[0]], self.strains[subset[-1]])
+        else:
+            omitted = [self.strains[k] for k in range(len(self.strains)) if k not in subset]
+            text = "omitted %s" %(",".join("%g" %e for e in omitted) if omitted else "none")
+        return text
+        
+    def store(self, filename, top=20):
+        """Writes the ranked fits to the file and prints the most stable ones."""
+        lines = ["# %d fits of %s, judged by the relative jackknife error of %s" %(len(self.subsets), self.input, ",".join(self.judge)),
+                 "# subset, strains used, stability score, residual standard deviation (GPa), %s" %", ".join(Constants.names)]
+        for i in self.order[:top]:
+            lines.append("%s, %d, %.4g, %.4g, %s" %(self.describe(i), self.masks[i].sum(), self.score[i], self.noise[i],
+                                                    ", ".join("%.6g(%.3g)" %item for item in zip(self.x[i], self.jackknife[i]))))
+        f = open(filename, 'w')
+        f.write("\n".join(lines)+"\n")
+        f.close()
+        print("\n".join(line[:160] for line in lines[:7]))
+        
+        
+class Truncation:
+    """
+    This class checks the truncation of the energy after the cubic terms. The data up to each strain value (smallest strains first)
+    is fitted with the nine constants and again with the higher order columns of Constants.higher added, all in one batch
+    from the blocks of Explore. The difference of the constants between the two fits is the part of the higher order energy
+    that the cubic fit puts into them. Its standard error is the square root of the difference of the variances of the two fits
+    (the cubic fit is the more precise one when there are no fourth order terms).
+    """
+    def __init__(self, inp, layout="blocks"):
+        self.input = inp
+        self.cubic = Explore(inp, layout)
+        self.augmented = Explore(inp, layout, higher=True)
+        self.strains = self.cubic.strains
+        
+    def check(self, tolerance=0.05, minstrains=3):
+        """Finds the shifts of the constants for every largest strain and the largest strain that is safe."""
+        n = len(self.strains)
+        # the fourth and fifth order terms need at least three strain values
+        first = max(minstrains, 3)-1
+        masks = np.tril(np.ones((n, n)))[first:]
+        self.largest = self.strains[first:]
+        x3, rss3, valid3, variance3 = self.cubic.solve(masks)
+        x4, rss4, valid4, variance4 = self.augmented.solve(masks)
+        energies = masks @ self.cubic.count
+        noise = rss4/np.maximum(energies-21, 1)
+        self.x, self.higher = x4[:, :9], x4[:, 9:]
+        self.shift = x3-self.x
+        self.error = np.sqrt(np.maximum(variance4[:, :9]-variance3, 0)*noise[:, None])
+        relative = abs(self.shift)/abs(self.x)
+        small = (relative <= tolerance) | (abs(self.shift) <= 2*self.error)
+        self.safe = valid3 & valid4 & np.all(small, axis=1)
+        unsafe = np.flatnonzero(~self.safe)
+        last = unsafe[0] if len(unsafe) else len(self.safe)
+        self.safest = self.largest[last-1] if last > 0 else None
+        self.tolerance = tolerance
+        return self.safest
+        
+    def store(self, filename):
+        """Writes the shifts of the constants for every largest strain and prints the largest safe strain."""
+        lines = ["# fits of %s up to each strain, with and without higher order terms; shift = cubic fit - fit with higher order terms" %self.input,
+                 "# largest strain, safe, %s (shift +- standard error in GPa), fourth and then fifth order coefficients of A1-A6 in GPa" %", ".join(Constants.names)]
+        for i in range(len(self.largest)):
+            lines.append("%g, %s, %s, %s" %(self.largest[i], "yes" if self.safe[i] else "no",
+                                            ", ".join("%.4g+-%.3g" %item for item in zip(self.shift[i], self.error[i])),
+                                            ", ".join("%.4g" %q for q in self.higher[i])))
+        if self.safest is None:
+            result = "No strain range is safe for the cubic expansion at the tolerance %g" %self.tolerance
+        else:
+            result = "The largest safe strain is %g (tolerance %g)" %(self.safest, self.tolerance)
+        lines.append("# "+result)
+        f = open(filename, 'w')
+        f.write("\n".join(lines)+"\n")
+        f.close()
+        print(result)
+        
+        
+class MonteCarlo:
+    """
+    This class gives the distributions of the constants and of all the derived results (names of Batch: compliances, directional
+    Young moduli, anisotropy, SOEC at the user pressure, polycrystal shear and TOECs) for noisy energies.
+    The energies are perturbed by normal noise (standard deviation in eV) samples times. All the samples share the matrix A,
+    so they are solved by one least square call with samples right sides, and Batch post-processes all of them at once.
+    """
+    def __init__(self, inp, layout="blocks", noise=0, samples=10000, seed=None):
+        self.input = inp
+        self.parser = Parser(self.input+".txt")
+        self.deformation, self.strain, self.energies = self.parser.readlayout(layout)
+        self.constants = Constants(volume=self.parser.volume, eqenergy=self.parser.eqenergy)
+        self.x, residual = self.constants.fit(self.deformation, self.strain, self.energies)
+        if not self.constants.identified.all():
+            raise ValueError("The available energies do not determine %s" %", ".join(np.array(Constants.names)[~self.constants.identified]))
+        if noise > 0:
+            self.noise = noise
+            self.source = "given"
+        elif self.constants.dof > 0:
+            # the residual of the fit weighted by the noise of every energy density, in eV as in Recommend
+            a, b = self.constants.weighted(self.deformation, self.strain, self.energies)
+            self.noise = np.sqrt(np.sum((a @ np.linalg.lstsq(a, b, rcond=None)[0] - b)**2)/self.constants.dof)
+            self.source = "from the residual"
+        else:
+            raise ValueError("The noise cannot be estimated from %d energies, give it with noise=" %len(self.energies))
+        self.samples = int(samples)
+        self.seed = seed
+        
+    def sample(self):
+        """Solves all the perturbed energy sets at once, returns the constants of the samples (samples, 9)."""
+        rng = np.random.default_rng(self.seed)
+        energies = self.energies + self.noise*rng.standard_normal((self.samples, len(self.energies)))
+        A = self.constants.rows(self.deformation, self.strain)
+        B = self.constants.density(energies, self.deformation, self.strain)
+        self.X = np.linalg.lstsq(A, B.T, rcond=None)[0].T
+        return self.X
+        
+    def propagate(self, pressure=1, steps=1000, percentiles=(2.5, 16, 50, 84, 97.5)):
+        """Post-processes the samples and the fit of the data (the first set of the batch) and finds the percentiles of all results."""
+        self.pressure = pressure
+        d = Batch(np.vstack([self.x, self.X]), pressure, steps)
+        self.names = Constants.names+d.derived
+        values = np.hstack([d.x, d.values])
+        self.value, self.values = values[0], values[1:]
+        self.levels = np.asarray(percentiles, dtype=float)
+        self.percentiles = np.percentile(self.values, self.levels, axis=0)
+        
+    def store(self, outpath):
+        """
+        Writes MonteCarlo.txt with the mean, standard deviation and percentiles of every result
+        and MonteCarlo.npz with all the samples (samples, names) and the percentiles.
+        """
+        lines = ["# %d samples of %s, energy noise %g eV (%s), (P) at %s GPa" %(self.samples, self.input, self.noise, self.source, self.pressure),
+                 "# name, value from the data, mean, standard deviation, percentiles %s" %", ".join("%g" %level for level in self.levels)]
+        mean, deviation = self.values.mean(axis=0), self.values.std(axis=0, ddof=1)
+        for j, name in enumerate(self.names):
+            lines.append("%s %.10g %.10g %.6g %s" %(name, self.value[j], mean[j], deviation[j], " ".join("%.10g" %p for p in self.percentiles[:, j])))
+        f = open(os.path.join(outpath, "MonteCarlo.txt"), 'w')
+        f.write("\n".join(lines)+"\n")
+        f.close()
+        np.savez(os.path.join(outpath, "MonteCarlo.npz"), names=np.array(self.names), value=self.value, samples=self.values,
+                 levels=self.levels, percentiles=self.percentiles, noise=np.array(self.noise))
+        print("\n".join(lines[:2]+lines[2:11]))
+        
+        
+class Synthetic:
+    """
+    This class is the forward model of the fit: for given constants, volume, equilibrium energy and strains it gives the energies
+    (12 for every strain, in the order of the input file) that the equations of Constants imply, so that a fit of them returns the
+    constants exactly. Fourth and fifth order terms (energy density quartic*e^4 + quintic*e^5 in GPa, one value or one for each
+    deformation) and normal noise (eV) can be added. The Cauchy stresses of the same calculations are given too (for stress=).
+    Many noisy sets are made as one array, so inputs of any size can be made without DFT, for tests and benchmarks.
+    """
+    # the constants fitted from example.txt
+    reference = (183.35, 132.97, 79.61, -1714.01, -1156.87, -443.45, -33.18, -687.85, 70.59)
+    
+    def __init__(self, constants=reference, volume=47.86, eqenergy=-15.0, strains=(0.007, 0.014, 0.021), quartic=0, quintic=0):
+        self.x = np.asarray(constants, dtype=float)
+        if self.x.shape != (9,):
+            raise ValueError("Nine constants are needed (%s), got %d" %(", ".join(Constants.names), self.x.size))
+        self.strains = np.asarray(strains, dtype=float)
+        self.constants = Constants(len(self.strains), volume, eqenergy, self.strains)
+        self.deformation, self.strain = self.constants.layout(self.strains)
+        self.higher = np.concatenate([np.broadcast_to(np.asarray(quartic, dtype=float), 6), np.broadcast_to(np.asarray(quintic, dtype=float), 6)])
+        
+    def energies(self, noise=0, count=None, rng=None):
+        """
+        Returns the energies (12*strains) or, with count, count sets of them as an array (count, 12*strains),
+        each with its own normal noise of standard deviation noise (eV).
+        """
+        density = self.constants.rows(self.deformation, self.strain) @ self.x + self.constants.higher(self.deformation, self.strain) @ self.higher
+        energies = self.constants.energies(density, self.deformation, self.strain)
+        shape = energies.shape if count is None else (count,)+energies.shape
+        if noise > 0:
+            rng = np.random.default_rng() if rng is None else rng
+            return energies + noise*rng.standard_normal(shape)
+        return np.broadcast_to(energies, shape).copy()
+        
+    def stresses(self, noise=0, rng=None, h=1e-30):
+        """
+        Returns the Cauchy stresses (12*strains, 6: xx, yy, zz, yz, xz, xy in GPa) of the deformed crystals, sigma = F S F^T / J,
+        with normal noise of standard deviation noise (GPa). The second Piola-Kirchhoff stress S is the derivative of the energy
+        expansion (Constants.strainenergy) by the Lagrangian strain eta = 1/2 (F^T F - I) of F = I + e*Ai, taken by complex steps
+        of every Voigt component, so it does not rely on the stress equations of the fit (Constants.stressrows).
+        The fourth and fifth order terms are energies of single deformations, not of a strain tensor, and give no stress.
+        """
+        eta = self.constants.voigt(self.deformation, self.strain)
+        S = np.zeros(eta.shape)
+        for i in range(6):
+            step = np.zeros(6, dtype=complex)
+            step[i] = 1j*h
+            S[:, i] = self.constants.strainenergy(self.x, eta+step).imag/h
+        S = S[:, [[0, 5, 4], [5, 1, 3], [4, 3, 2]]]
+        F = np.eye(3) + self.strain[:, None, None]*Constants.deformations[self.deformation]
+        sigma = F @ S @ np.swapaxes(F, 1, 2)/np.linalg.det(F)[:, None, None]
+        stress = np.stack([sigma[:, 0, 0], sigma[:, 1, 1], sigma[:, 2, 2], sigma[:, 1, 2], sigma[:, 0, 2], sigma[:, 0, 1]], axis=1)
+        if noise > 0:
+            rng = np.random.default_rng() if rng is None else rng
+            stress = stress + noise*rng.standard_normal(stress.shape)
+        return stress
+        
+    def text(self, energies):
+        """Returns one input file (the form of example.txt, one value per line) for the energies."""
+        values = [len(self.strains), self.constants.volume, self.constants.eqenergy]+self.strains.tolist()+list(energies)
+        return "\n".join("%.17g" %value for value in values)+"\n"
+        
+    def write(self, filename, energies):
+        """Writes the energies to an input file. With several sets (count, 12*strains) the records are written one after
+        another, each named "#@ sample i", in the form read by stream."""
+        energies = np.asarray(energies)
+        f = open(filename, 'w')
+        if energies.ndim == 1:
+            f.write(self.text(energies))
+        else:
+            for i, record in enumerate(energies, 1):
+                f.write("#@ sample %d\n" %i)
+                f.write(self.text(record))
+        f.close()
+        
+        
+class Parser:
+    """
+    This class reads the input file (see the example file) into one array of floats.
+    The header (number of strain values, volume, equilibrium energy), the strains and the energies are views into that array,
+    so nothing is copied after the file is read. Everything after # on a line is a comment.
+    The number of values is checked against 3 + n + 12*n, where n is the number of strain values
+    and every error names the line of the input file where it was found.
+    """
+    def __init__(self, filename, deformations=12):
+        self.filename = filename
+        self.deformations = deformations
+        
+    def numbers(self):
+        """Reads the whole file into one array of floats, comments are removed."""
+        f = open(self.filename, 'rb')
+        self.text = f.read()
+        f.close()
+        tokens = re.sub(rb"#[^\n]*", b"", self.text).split()
+        try:
+            self.data = np.array(tokens, dtype=float)
+        except ValueError:
+            for index, token in enumerate(tokens):
+                try:
+                    float(token)
+                except ValueError:
+                    self.error(index, "'%s' is not a number" %token.decode(errors="replace"))
+        return self.data
+        
+    def read(self):
+        """Reads and checks the file. Returns the whole array, the parts are stored as ndeltas, volume, eqenergy, deltas and energies."""
+        self.numbers()
+        if len(self.data) < 3:
+            self.error(len(self.data), "the file must start with the number of strain values, the volume and the equilibrium energy")
+        n = self.data[0]
+        if not (np.isfinite(n) and n >= 1 and n == int(n)):
+            self.error(0, "the number of strain values must be a positive integer, got %s" %n)
+        if not self.data[1] > 0:
+            self.error(1, "the volume must be positive, got %s" %self.data[1])
+        n = int(n)
+        expected = 3+n+self.deformations*n
+        if len(self.data) != expected:
+            message = "expected %d values (3 + %d strains + %d*%d energies) but found %d" %(expected, n, self.deformations, n, len(self.data))
+            self.error(min(expected, len(self.data)), message)
+        
+        self.ndeltas = n
+        self.volume = self.data[1]
+        self.eqenergy = self.data[2]
+        self.deltas = self.data[3:3+n]
+        self.energies = self.data[3+n:]
+        return self.data
+        
+    def readlong(self):
+        """
+        Reads and checks a file in the long layout: the volume and the equilibrium energy, then one line for every energy with
+        the deformation (1 for A1 ... 6 for A6), the sign of the strain (1 or -1), the strain and the energy.
+        Every deformation and sign can have its own list of strains. Besides volume, eqenergy and energies, the deformation index
+        (0 for A1), the signed strain and the table (a view with four columns) are stored; deltas are the distinct strains.
+        """
+        self.numbers()
+        if len(self.data) < 2:
+            self.error(len(self.data), "the file must start with the volume and the equilibrium energy")
+        if not self.data[0] > 0:
+            self.error(0, "the volume must be positive, got %s" %self.data[0])
+        if (len(self.data)-2)%4 != 0:
+            self.error(len(self.data), "expected 4 values (deformation, sign, strain, energy) on every line, %d values are left over" %((len(self.data)-2)%4))
+        self.table = self.data[2:].reshape(-1, 4)
+        for column, valid, message in ((0, lambda x: np.isin(x, np.arange(1, 7)), "the deformation must be 1 to 6, got %s"),
+                                       (1, lambda x: abs(x) == 1, "the sign must be 1 or -1, got %s"),
+                                       (2, lambda x: np.isfinite(x) & (x > 0), "the strain must be positive, got %s")):
+            bad = np.flatnonzero(~valid(self.table[:, column]))
+            if len(bad):
+                self.error(2+4*bad[0]+column, message %self.table[bad[0], column])
+        
+        self.volume = self.data[0]
+        self.eqenergy = self.data[1]
+        self.deformation = self.table[:, 0].astype(int)-1
+        self.strain = self.table[:, 1]*self.table[:, 2]
+        self.energies = self.table[:, 3]
+        self.deltas = np.unique(self.table[:, 2])
+        self.ndeltas = len(self.deltas)
+        return self.data
+        
+    def readlayout(self, layout="blocks"):
+        """
+        Reads and checks the file in the given layout: blocks (the form of example.txt, see read) or long (see readlong).
+        For both the deformation index (0 for A1) and the signed strain of every energy are stored, and known marks the energies
+        that are given (not NaN). Returns the deformation, strain and energy of the known energies, ready for Constants.fit.
+        """
+        if layout == "long":
+            self.readlong()
+        elif layout == "blocks":
+            self.read()
+            self.deformation, self.strain = Constants().layout(self.deltas)
+        else:
+            raise ValueError("Unknown input layout '%s', use blocks or long" %layout)
+        self.known = np.isfinite(self.energies)
+        return self.deformation[self.known], self.strain[self.known], self.energies[self.known]
+        
+    def readstress(self, count):
+        """
+        Reads a stress file: six values for every one of the count calculations, in the order of the energies of the input file
+        (one calculation per line): the Cauchy stress xx, yy, zz, yz, xz, xy in GPa, tensile positive. NaN marks a missing stress.
+        Returns an array (count, 6).
+        """
+        self.numbers()
+        if len(self.data) != 6*count:
+            self.error(min(len(self.data), 6*count), "expected 6 stress components for each of the %d energies, got %d values" %(count, len(self.data)))
+        return self.data.reshape(count, 6)
+        
+    def records(self):
+        """
+        Yields the records of a file that holds several materials, one after another, without reading the whole file.
+        Each record has the same form as a single input file (number of strains, volume, equilibrium energy, strains, energies),
+        the records are simply written one after the other. A comment line "#@ name" before a record gives it a name,
+        otherwise the records are named "record 1", "record 2"... Every record is a Parser with the same attributes as after read.
+        """
+        f = open(self.filename, 'rb')
+        values = []
+        name = None
+        expected = None
+        count = 0
+        number = 0
+        for number, line in enumerate(f, start=1):
+            text, hashmark, comment = line.partition(b"#")
+            if not values and comment.startswith(b"@"):
+                name = comment[1:].strip().decode(errors="replace")
+            tokens = text.split()
+            if not tokens:
+                continue
+            try:
+                values.extend(map(float, tokens))
+            except ValueError:
+                for token in tokens:
+                    try:
+                        float(token)
+                    except ValueError:
+                        raise ValueError("%s, line %d: '%s' is not a number" %(self.filename, number, token.decode(errors="replace"))) from None
+            # A line may end one record and start the next one
+            while values:
+                if expected is None:
+                    n = values[0]
+                    if not (np.isfinite(n) and n >= 1 and n == int(n)):
+                        raise ValueError("%s, line %d: the number of strain values must be a positive integer, got %s" %(self.filename, number, n))
+                    expected = 3+int(n)+self.deformations*int(n)
+                if len(values) >= 2 and not values[1] > 0:
+                    raise ValueError("%s, line %d: the volume must be positive, got %s" %(self.filename, number, values[1]))
+                if len(values) < expected:
+                    break
+                count += 1
+                yield self.record(values[:expected], name if name else "record %d" %count)
+                values = values[expected:]
+                name = None
+                expected = None
+        f.close()
+        if values:
+            raise ValueError("%s, line %d: the last record is incomplete, expected %s values but found %d" %(self.filename, number, expected, len(values)))
+            
+    def record(self, values, name):
+        """Returns a Parser holding one record of a file with several materials."""
+        record = Parser(self.filename, self.deformations)
+        record.name = name
+        record.data = np.array(values)
+        record.ndeltas = int(record.data[0])
+        record.volume = record.data[1]
+        record.eqenergy = record.data[2]
+        record.deltas = record.data[3:3+record.ndeltas]
+        record.energies = record.data[3+record.ndeltas:]
+        return record
+        
+    def error(self, index, message):
+        """
+        Raises a ValueError for the value number index (counted from zero), naming the line it is on.
+        If the file has fewer values, the line of the last value is named.
+        """
+        line = 0
+        for number, text in enumerate(self.text.split(b"\n"), start=1):
+            values = len(text.split(b"#", 1)[0].split())
+            if values:
+                line = number
+            index -= values
+            if index < 0:
+                break
+        raise ValueError("%s, line %d: %s" %(self.filename, line, message))
+        
 class Constants:
     """This code calculates the SOECs and TOECs when given input of the form:"
     "Number of measurements, Volume, Eq. Energy, all strain values in a list and all the energies in another list"
     "The energies are in the order A1+, A1-, A2+, A2- for first strain and than repeated for the other values of strain"
-    "The solution is found using the least square method numpy.linalg.lstsq"""
+    "The solution is found using the least square method numpy.linalg.lstsq"
+    "Energies given as NaN (failed or missing calculations) are left out, and constants that the remaining energies"
+    "do not determine are returned as NaN"""
+    
+    # Names of the constants, in the order of the columns of the equations and of the results
+    names = ("C11", "C12", "C44", "C111", "C112", "C123", "C144", "C166", "C456")
+    # The energy density of deformation Ai with strain e is (quadratic[i]*e^2 + cubic[i]*e^3) . (C11, C12, C44, C111, C112, C123, C144, C166, C456)
+    quadratic = np.array([[0.5, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+                          [1.0, 1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+                          [1.5, 3.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+                          [0.5, 0.0, 2.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+                          [0.5, 0.0, 2.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+                          [0.0, 0.0, 6.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]])
+    cubic = np.array([[0.0, 0.0, 0.0, 1/6, 0.0, 0.0, 0.0, 0.0, 0.0],
+                      [0.0, 0.0, 0.0, 1/3, 1.0, 0.0, 0.0, 0.0, 0.0],
+                      [0.0, 0.0, 0.0, 0.5, 3.0, 1.0, 0.0, 0.0, 0.0],
+                      [0.0, 0.0, 0.0, 1/6, 0.0, 0.0, 2.0, 0.0, 0.0],
+                      [0.0, 0.0, 0.0, 1/6, 0.0, 0.0, 0.0, 2.0, 0.0],
+                      [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 8.0]])
+    # The deformation matrices A1...A6 for unit strain, the deformation is the identity plus strain times these
+    deformations = np.array([[[1., 0., 0.], [0., 0., 0.], [0., 0., 0.]],
+                             [[1., 0., 0.], [0., 1., 0.], [0., 0., 0.]],
+                             [[1., 0., 0.], [0., 1., 0.], [0., 0., 1.]],
+                             [[1., 0., 0.], [0., 0., 1.], [0., 1., 0.]],
+                             [[1., 1., 0.], [1., 0., 0.], [0., 0., 0.]],
+                             [[0., 1., 1.], [1., 0., 1.], [1., 1., 0.]]])
+    # conversion of eV per cubic angstroem to GPa
+    eVA3 = 160.217662000
           
     def __init__(self, ndeltas = 1, volume = 47.11, eqenergy = 0, delta = [0.021], energy = np.array([0.0, 0.0, 0.0, 0.0, 0.0, 0.0])):
         # the energies are stored with equilibirum energy as an independent variable,
@@ -188,8 +1410,64 @@ class Constants:
       self.eqenergy = eqenergy
       self.energy = energy
       self.ndeltas = ndeltas
+      
+    def layout(self, deltas):
+        """
+        Returns the deformation index (0 for A1 ... 5 for A6) and the signed strain of every energy
+        for the input order: A1+, A1-, A2+ ... A6- for the first strain, then the same for the other strains.
+        """
+        deltas = np.asarray(deltas, dtype=float)
+        deformation = np.tile(np.repeat(np.arange(6), 2), len(deltas))
+        strain = np.repeat(deltas, 12)*np.tile([1.0, -1.0], 6*len(deltas))
+        return deformation, strain
+        
+    def rows(self, deformation, strain):
+        """Returns the rows of the matrix A for the given deformation indices and signed strains, all at once."""
+        strain = np.asarray(strain, dtype=float)[:, None]
+        return self.quadratic[deformation]*strain**2 + self.cubic[deformation]*strain**3
+        
+    def higher(self, deformation, strain):
+        """
+        Returns twelve higher order columns, two for every deformation: strain^4 and strain^5 for its energies and zero for the others
+        (the fourth order columns of A1-A6 first, then the fifth order ones). They take up the higher order terms of the energy that
+        the constants would otherwise absorb: with positive and negative strains the even fourth order terms go into the SOEC
+        and the odd fifth order terms into the TOEC.
+        """
+        strain = np.asarray(strain, dtype=float)[:, None]
+        own = np.asarray(deformation)[:, None] == np.arange(6)
+        return np.hstack([own*strain**4, own*strain**5])
+        
+    def determinants(self, deformation, strain):
+        """
+        The determinant of every deformation matrix is used as a correction to the volume of the crystal.
+        (As the volume of the crystal change from the equilibirium value when deformed and it is important to incorporate this change in the script)"""
+        strain = np.asarray(strain, dtype=float)
+        return abs(np.linalg.det(np.eye(3) + strain[:, None, None]*self.deformations[deformation]))
+        
+    def density(self, energy, deformation, strain):
+        """Returns the energy density difference (right side B) in GPa for the given energies."""
+        return (np.asarray(energy)-self.eqenergy)*self.eVA3/(self.volume*self.determinants(deformation, strain))
+        
+    def variances(self, deformation, strain, noise=1.0):
+        """
+        Returns the variance of the right side B of every energy for an energy noise (standard deviation in eV): as B is the energy
+        divided by the volume of the deformed crystal, it is (noise*eVA3/(V*det))^2. Design and Recommend weight the rows by its inverse.
+        """
+        return (noise*self.eVA3/(self.volume*self.determinants(deformation, strain)))**2
+        
+    def weighted(self, deformation, strain, energies):
+        """
+        Returns the rows and right sides of the energies divided by the standard deviation of the right side for an energy noise
+        of 1 eV (variances), so that the residual of their least square solution is in eV. Recommend and MonteCarlo estimate the noise from it.
+        """
+        scale = 1/np.sqrt(self.variances(deformation, strain))
+        return self.rows(deformation, strain)*scale[:, None], self.density(energies, deformation, strain)*scale
+        
+    def energies(self, density, deformation, strain):
+        """The inverse of density: returns the energies in eV for the energy density differences in GPa."""
+        return self.eqenergy + np.asarray(density)*self.volume*self.determinants(deformation, strain)/self.eVA3
     
-    def solve(self):
+    def solve(self, stress=None):
         """
         This is the method responsible for the calculation of SOEC and TOEC. When feeded appropriate infromation by its __init__ it
         creates arrays and matrix necessary for least square method solution.
@@ -197,100 +1475,289 @@ class Constants:
         A is a n*9 matrix where n is equal to 12*number of delta values used. So it is always overdefined
         B is a 1-D array of energy density difference.
         The values in the X array are being calculated for given A and B
+        With the stresses of the calculations (array (n, 6), see joint) the stresses are fitted together with the energies.
         """
-        i=0
-        a=[] # coefficient matrix
-        b = [] # right side matrix (inhomogenous part)
-        
-        for i in range (0,int(self.ndeltas)):
-            self.ddelta = self.delta[i]
-            Constants.matrix(self)
-            deltasquared = self.delta[i]**2
-            deltacubed = abs(self.delta[i]**3)
-            
-            x=0
-            for x in range (0,12):
-                count= x+(i*12)  
-                             
-                Pos = ((self.energy[count]-self.eqenergy)*160.217662000/(self.volume*self.determinant[x])) # changing the energy to joules                   
-                b.append(Pos)
-                
-                    
-        # matrix A with coefficients for matrix x with: C11, C111, C12, C112, C123, C44, C144, C166, C456        
-            
-            a.extend([[0.5*deltasquared, deltacubed/6, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
-                [0.5*deltasquared, -1*deltacubed/6, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
-                [1*deltasquared, deltacubed/3, 1*deltasquared, 1*deltacubed, 0.0, 0.0, 0.0, 0.0, 0.0],
-                [deltasquared, -1*deltacubed/3, deltasquared, -1*deltacubed, 0.0, 0.0, 0.0, 0.0, 0.0],
-                [deltasquared*3/2, deltacubed/2, 3*deltasquared, 3*deltacubed, deltacubed, 0.0, 0.0, 0.0, 0.0],
-                [deltasquared*3/2, -deltacubed/2, 3*deltasquared, -3*deltacubed, -deltacubed, 0.0, 0.0, 0.0, 0.0],
-                [deltasquared/2, deltacubed/6, 0.0, 0.0, 0.0, 2*deltasquared, 2*deltacubed, 0.0, 0.0],
-                [deltasquared/2, -deltacubed/6, 0.0, 0.0, 0.0, 2*deltasquared, -2*deltacubed, 0.0, 0.0],
-                [deltasquared/2, deltacubed/6, 0.0, 0.0, 0.0, 2*deltasquared, 0.0, 2*deltacubed, 0.0],
-                [deltasquared/2, -deltacubed/6, 0.0, 0.0, 0.0, 2*deltasquared, 0.0, -2*deltacubed, 0.0],
-                [0.0, 0.0, 0.0, 0.0, 0.0, 6*deltasquared, 0.0, 0.0, 8*deltacubed],
-                [0.0, 0.0, 0.0, 0.0, 0.0, 6*deltasquared, 0.0, 0.0, -8*deltacubed]])
-                     
-        newb = np.array(b)    
-        amatrix = np.matrix(a)
-        x, residues, rank, s = np.linalg.lstsq(amatrix, newb, rcond=None)
-
-        #rearrange the output. This is as the ideal output is in different order than the equations
-        dummy = x[1]
-        x[1] = x[2]
-        x[2] = x[5]
-        x[5] = x[4]
-        x[4] = x[3]
-        x[3] = dummy
-
+        deformation, strain = self.layout(self.delta[:int(self.ndeltas)])
+        if stress is not None:
+            return self.joint(deformation, strain, self.energy[:len(strain)], stress[:len(strain)])
+        return self.fit(deformation, strain, self.energy[:len(strain)])
+        
+    def fit(self, deformation, strain, energy):
+        """
+        Solves the least square problem for any set of energies, each given with its deformation index (0 for A1 ... 5 for A6)
+        and signed strain, so the deformations do not need to share the same strains.
+        """
+        a = self.rows(deformation, strain) # coefficient matrix
+        b = self.density(energy, deformation, strain) # right side matrix (inhomogenous part)
+        # rows of missing energies (NaN) are dropped, the rest of the data is used as it is
+        known = np.isfinite(b)
+        self.missing = [(deformation[i], strain[i]) for i in np.flatnonzero(~known)]
+        a, b = a[known], b[known]
+        x, residues, rank, s = np.linalg.lstsq(a, b, rcond=None)
+        self.identified = self.identifiable(a)
+        self.covariance = self.covariancematrix(a, b, x)
+        self.deformation, self.strain, self.known = np.asarray(deformation), np.asarray(strain, dtype=float), known
+        self.influence(a, b, x)
+        x[~self.identified] = np.nan
         return x, residues
         
+    def identifiable(self, a):
+        """
+        Returns for every constant whether the rows a determine it. A constant is not determined when a direction of the
+        null space of a (right singular vectors with zero singular value) changes it, since then any value of it fits equally well.
+        The singular values and vectors are kept (singular, vt, rank) for the covariance of the constants.
+        """
+        if len(a) == 0:
+            self.singular, self.vt, self.rank, self.u = np.zeros(0), np.eye(a.shape[1]), 0, np.zeros((0, 0))
+            return np.zeros(a.shape[1], dtype=bool)
+        u, self.singular, self.vt = np.linalg.svd(a)
+        self.rank = int(np.sum(self.singular > max(a.shape)*np.finfo(float).eps*self.singular[0]))
+        self.u = u[:, :self.rank]
+        return np.sqrt(np.sum(self.vt[self.rank:]**2, axis=0)) < 1e-8
+        
+    def covariancematrix(self, a, b, x):
+        """
+        Returns the covariance of the constants from the singular value decomposition of the identifiable method:
+        C = s^2 (A^T A)^-1 = s^2 V S^-2 V^T, where the noise s^2 = |A x - B|^2 / (n - rank) is estimated from the residual.
+        The unscaled part (A^T A)^-1 is kept as unscaled. Rows and columns of constants that are not determined are NaN,
+        and the whole matrix is NaN when there are no more energies than determined combinations of constants.
+        """
+        rank = self.rank
+        self.unscaled = (self.vt[:rank].T/self.singular[:rank]**2) @ self.vt[:rank]
+        self.dof = len(a)-rank
+        self.variance = np.sum((a @ x - b)**2)/self.dof if self.dof > 0 else np.nan
+        covariance = self.variance*self.unscaled
+        covariance[~self.identified] = np.nan
+        covariance[:, ~self.identified] = np.nan
+        return covariance
         
-    def matrix(self):
+    def tensors(self):
         """
-        This method generates the deformation matirces.
-        The determinant is calculated and used as a correction to the volume of the crystal.
-        (As the volume of the crystal change from the equilibirium value when deformed and it is important to incorporate this change in the script)"""
-        self.mdelta = self.ddelta
-        self.base = np.array([[1.0, 0., 0.],
-                                [0., 1.0, 0.],
-                                [0., 0., 1.0]])
-                                
-        self.A1 = np.array([[self.mdelta, 0., 0.],
-                                [0., 0., 0.],
-                                [0., 0., 0.]])
-                                
-        self.A2 = np.array([[self.mdelta, 0., 0.],
-                                [0., self.mdelta, 0.],
-                                [0., 0., 0.]])
-                                
-        self.A3 = np.array([[self.mdelta, 0., 0.],
-                                [0., self.mdelta, 0.],
-                                [0., 0., self.mdelta]])
-                                
-        self.A4 = np.array([[self.mdelta, 0., 0.],
-                                [0., 0., self.mdelta],
-                                [0., self.mdelta, 0.]])
-                                
-        self.A5 = np.array([[self.mdelta, self.mdelta, 0.],
-                                [self.mdelta, 0., 0.],
-                                [0., 0., 0.]])
-            
-        self.A6 = np.array([[0., self.mdelta, self.mdelta],
-                                [self.mdelta, 0., self.mdelta],
-                                [self.mdelta, self.mdelta, 0.]])    
-                              
-        i=0
-        self.list = (self.A1, self.A2, self.A3, self.A4, self.A5, self.A6)
-        self.determinant = np.array([0.0]*12)
-        for matrix in self.list:
-            self.matrix = self.base+matrix
-            self.negmatrix = self.base-matrix
-            self.determinant[2*i] = abs(np.linalg.det(self.matrix))
-            self.determinant[2*i+1] = abs(np.linalg.det(self.negmatrix))                        
-            i+=1
+        Returns the elastic tensors in Voigt notation for a unit value of each constant, (9, 6, 6) for the SOEC and (9, 6, 6, 6)
+        for the TOEC, so that C_ij = sum_p x_p second[p, i, j] and C_ijk = sum_p x_p third[p, i, j, k].
+        Each TOEC stands for all the index triples that are equal to it in a cubic crystal, and for all their permutations.
+        """
+        second = np.zeros((9, 6, 6))
+        third = np.zeros((9, 6, 6, 6))
+        for i in range(3):
+            second[0, i, i] = second[2, i+3, i+3] = 1
+            second[1, i, [j for j in range(3) if j != i]] = 1
+        triples = {3: [(0, 0, 0), (1, 1, 1), (2, 2, 2)],
+                   4: [(0, 0, 1), (0, 0, 2), (1, 1, 0), (1, 1, 2), (2, 2, 0), (2, 2, 1)],
+                   5: [(0, 1, 2)],
+                   6: [(0, 3, 3), (1, 4, 4), (2, 5, 5)],
+                   7: [(0, 4, 4), (0, 5, 5), (1, 3, 3), (1, 5, 5), (2, 3, 3), (2, 4, 4)],
+                   8: [(3, 4, 5)]}
+        for p, indices in triples.items():
+            for index in indices:
+                for permutation in itertools.permutations(index):
+                    third[(p,)+permutation] = 1
+        return second, third
+        
+    def voigt(self, deformation, strain):
+        """
+        Returns the Lagrangian strains of the deformed crystals in Voigt notation (xx, yy, zz, 2yz, 2xz, 2xy), shape (n, 6):
+        eta = 1/2 (F^T F - I) with the deformation F = I + e*Ai, that is e*Ai + 1/2 e^2 Ai^2 for the symmetric Ai.
+        The second order part is of the same order in e as the TOEC terms of the stress, so it must not be dropped.
+        """
+        F = np.eye(3) + np.asarray(strain, dtype=float)[:, None, None]*self.deformations[deformation]
+        eta = 0.5*(np.swapaxes(F, 1, 2) @ F - np.eye(3))
+        return np.stack([eta[:, 0, 0], eta[:, 1, 1], eta[:, 2, 2], 2*eta[:, 1, 2], 2*eta[:, 0, 2], 2*eta[:, 0, 1]], axis=1)
+        
+    def strainenergy(self, x, eta):
+        """
+        Returns the energy density in GPa, W = 1/2 C_ij eta_i eta_j + 1/6 C_ijk eta_i eta_j eta_k, of the constants x for any strains
+        eta in Voigt notation (n, 6). Complex strains are allowed, for derivatives by complex steps. For the strain e*Ai of a
+        deformation it is the energy density of the rows method, rows @ x.
+        """
+        second, third = self.tensors()
+        x = np.asarray(x, dtype=float)
+        eta = np.asarray(eta)
+        return (0.5*np.einsum('pij,p,ni,nj->n', second, x, eta, eta)
+                + np.einsum('pijk,p,ni,nj,nk->n', third, x, eta, eta, eta)/6)
+        
+    def stressrows(self, deformation, strain):
+        """
+        Returns the rows of the stress equations, (n, 6, 9): the second Piola-Kirchhoff stress is the derivative of the energy density
+        W = 1/2 C_ij eta_i eta_j + 1/6 C_ijk eta_i eta_j eta_k (the expansion of the rows method) by the Lagrangian strain of voigt,
+        S_i = C_ij eta_j + 1/2 C_ijk eta_j eta_k, which is linear in the constants like the energy density.
+        """
+        second, third = self.tensors()
+        eta = self.voigt(deformation, strain)
+        return np.einsum('pij,nj->nip', second, eta) + 0.5*np.einsum('pijk,nj,nk->nip', third, eta, eta)
+        
+    def pk2(self, stress, deformation, strain):
+        """
+        Turns the Cauchy stresses (n, 6) of the deformed crystals into the second Piola-Kirchhoff stresses of the reference
+        (right sides of the stress equations): S = J F^-1 sigma F^-T, with the deformation F = I + e*Ai and J = det F.
+        """
+        stress = np.asarray(stress, dtype=float)
+        sigma = stress[:, [[0, 5, 4], [5, 1, 3], [4, 3, 2]]]
+        F = np.eye(3) + np.asarray(strain, dtype=float)[:, None, None]*self.deformations[deformation]
+        Finv = np.linalg.inv(F)
+        S = np.linalg.det(F)[:, None, None]*Finv @ sigma @ np.swapaxes(Finv, 1, 2)
+        return np.stack([S[:, 0, 0], S[:, 1, 1], S[:, 2, 2], S[:, 1, 2], S[:, 0, 2], S[:, 0, 1]], axis=1)
+        
+    def joint(self, deformation, strain, energy, stress, iterations=50):
+        """
+        Fits the energies and the stresses of the same calculations together: the six stress components of every calculation
+        are added as rows to the energy equations. The two kinds of rows have different units and noise, so each kind is divided
+        by its own noise, which is estimated from the fit and the fit repeated until the noises settle (feasible generalized least squares).
+        The noise of a kind is its sum of squared residuals over its number of rows less its share of the fitted parameters
+        (the sum of its leverages). The energies alone are fitted first (fit) to keep the data; the diagnostics of the energies
+        (influence) are then found again from the final weighted joint fit, so they describe the same fit as the constants.
+        Returns the constants and the sum of squared residuals of the energies, like fit. The noises are kept in noise (energy density, stress).
+        """
+        self.fit(deformation, strain, energy)
+        ae, be = self.rows(deformation, strain), self.density(energy, deformation, strain)
+        known = np.isfinite(be)
+        ae, be = ae[known], be[known]
+        as_ = self.stressrows(deformation, strain).reshape(-1, 9)
+        bs = self.pk2(stress, deformation, strain).ravel()
+        measured = np.isfinite(bs)
+        as_, bs = as_[measured], bs[measured]
+        self.nstress = len(bs)
+        a, b = np.vstack([ae, as_]), np.concatenate([be, bs])
+        kind = np.concatenate([np.zeros(len(be), dtype=int), np.ones(len(bs), dtype=int)])
+        noise = np.array([1.0, 1.0])
+        for iteration in range(iterations):
+            weight = 1/noise[kind]
+            x = np.linalg.lstsq(a*weight[:, None], b*weight, rcond=None)[0]
+            self.identified = self.identifiable(a*weight[:, None])
+            leverage = np.sum(self.u**2, axis=1)
+            rss = np.bincount(kind, weights=(a @ x - b)**2, minlength=2)
+            dof = np.bincount(kind, weights=1-leverage, minlength=2)
+            new = np.sqrt(np.where(dof > 0, rss/np.maximum(dof, 1e-300), noise**2))
+            new = np.where(new > 0, new, noise)
+            converged = np.allclose(new, noise, rtol=1e-8)
+            noise = new
+            if converged:
+                break
+        self.noise = noise
+        weight = 1/noise[kind]
+        x = np.linalg.lstsq(a*weight[:, None], b*weight, rcond=None)[0]
+        self.identified = self.identifiable(a*weight[:, None])
+        rss = np.bincount(kind, weights=(a @ x - b)**2, minlength=2)
+        self.unscaled = (self.vt[:self.rank].T/self.singular[:self.rank]**2) @ self.vt[:self.rank]
+        self.dof = len(a)-self.rank
+        self.variance = 1.0
+        self.covariance = self.unscaled.copy()
+        self.covariance[~self.identified] = np.nan
+        self.covariance[:, ~self.identified] = np.nan
+        self.influence(a, b, x, weight)
+        x[~self.identified] = np.nan
+        return x, np.array([rss[0]])
+        
+    def influence(self, a, b, x, weight=None):
+        """
+        Finds the influence of every energy on the fit from the same singular value decomposition, without refitting:
+            leverage h_i = sum_k U_ik^2 (diagonal of the hat matrix A (A^T A)^-1 A^T),
+            studentized residual t_i = e_i/(s_(i) sqrt(1-h_i)), with s_(i) the noise of the fit without energy i,
+            Cook's distance D_i = r_i^2 h_i/(p (1-h_i)), with r_i = e_i/(s sqrt(1-h_i)) and p the number of determined combinations.
+        For a weighted fit (joint) the decomposition is that of the weighted rows, the residuals are weighted for t and D,
+        and only the energy rows, which come first, are kept.
+        The arrays (residual e in GPa, leverage, studentized, cook) have one value for every energy given to fit, NaN for the missing ones.
+        """
+        n, p = len(a), self.rank
+        residual = b - a @ x
+        weighted = residual if weight is None else residual*weight
+        leverage = np.sum(self.u**2, axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            r = weighted/np.sqrt(self.variance*(1-leverage))
+            studentized = r*np.sqrt((n-p-1)/(n-p-r**2))
+            cook = r**2*leverage/(p*(1-leverage))
+        count = int(self.known.sum())
+        for name, values in (("residual", residual), ("leverage", leverage), ("studentized", studentized), ("cook", cook)):
+            full = np.full(len(self.known), np.nan)
+            full[self.known] = values[:count]
+            setattr(self, name, full)
             
-
+    def flags(self):
+        """
+        Marks the energies that stand out: L for a high leverage (h > 2p/n), O for an outlier (|t| > 3)
+        and I for an influential energy (Cook's distance > 4/n). Returns one string for every energy, empty when none applies.
+        """
+        n, p = int(self.known.sum()), self.rank
+        marks = [(self.leverage > 2*p/n, "L"), (abs(self.studentized) > 3, "O"), (self.cook > 4/n, "I")]
+        return ["".join(mark for flagged, mark in marks if flagged[i]) for i in range(len(self.known))]
+        
+    def storeinfluence(self, filename):
+        """
+        Writes the influence of every energy to the file. The outliers and influential energies are also listed at the top
+        (a high leverage alone is common at the largest strains and only marked in the table).
+        """
+        flags = self.flags()
+        flagged = [i for i in range(len(flags)) if flags[i].strip("L")]
+        lines = ["# Influence of every energy on the %s: L high leverage (h > 2p/n), O outlier (|t| > 3), I influential (Cook's distance > 4/n)" %self.fitted(),
+                 "# outliers and influential: %s" %(", ".join("A%d%s at strain %s (%s)" %(self.deformation[i]+1, "+" if self.strain[i] > 0 else "-",
+                                                                          abs(self.strain[i]), flags[i]) for i in flagged) or "none"),
+                 "# deformation, strain, residual in GPa, leverage, studentized residual, Cook's distance, flags"]
+        for i in range(len(flags)):
+            lines.append("A%d %+.6g %.6g %.4g %.4f %.4g %s" %(self.deformation[i]+1, self.strain[i], self.residual[i], self.leverage[i],
+                                                             self.studentized[i], self.cook[i], flags[i]))
+        f = open(filename, 'w')
+        f.write("\n".join(line.rstrip() for line in lines)+"\n")
+        f.close()
+        
+    def fitted(self):
+        """Names the fit that the diagnostics describe."""
+        if hasattr(self, "nstress"):
+            return "joint fit of the energies and %d stresses" %self.nstress
+        return "fit"
+        
+    def breakdown(self):
+        """
+        Splits the residual of the fit by deformation and sign with one bincount over the group 2*deformation + (strain < 0).
+        Returns the number of energies, the sum of squared residuals and the largest absolute residual, each as an array (6, 2)
+        with the rows A1 ... A6 and the columns positive, negative strain.
+        """
+        known = self.known
+        group = 2*self.deformation[known] + (self.strain[known] < 0)
+        residual = self.residual[known]
+        count = np.bincount(group, minlength=12)
+        rss = np.bincount(group, weights=residual**2, minlength=12)
+        largest = np.zeros(12)
+        np.maximum.at(largest, group, abs(residual))
+        return count.reshape(6, 2), rss.reshape(6, 2), largest.reshape(6, 2)
+        
+    def storeresiduals(self, filename):
+        """Writes the table of the breakdown method: for every deformation and sign the root mean square and largest residual and its share."""
+        count, rss, largest = self.breakdown()
+        total = rss.sum()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rms = np.sqrt(rss/count)
+        lines = ["# Residual of the %s by deformation and sign, in GPa (the right side is the energy density)" %self.fitted(),
+                 "# deformation, energies, root mean square residual, largest residual, share of the sum of squares in %"]
+        for k in range(6):
+            for j, sign in enumerate("+-"):
+                lines.append("A%d%s %d %.4g %.4g %.1f" %(k+1, sign, count[k, j], rms[k, j], largest[k, j],
+                                                         100*rss[k, j]/total if total > 0 else 0))
+        f = open(filename, 'w')
+        f.write("\n".join(lines)+"\n")
+        f.close()
+        
+    def note(self):
+        """Describes the missing energies and the constants that are not determined, empty when all data was used."""
+        if hasattr(self, "nstress"):
+            text = "fitted with %d stress components, noise %.3g GPa (energy density) and %.3g GPa (stress)" %((self.nstress,)+tuple(self.noise))
+            if self.missing:
+                text += "; "+self.energynote()
+            elif not self.identified.all():
+                text += "; not determined: %s" %", ".join(np.array(self.names)[~self.identified])
+            return text
+        return self.energynote()
+        
+    def energynote(self):
+        """Describes the missing energies and the constants that are not determined, empty when all data was used."""
+        if not self.missing:
+            return ""
+        text = "%d energies missing: %s" %(len(self.missing), ", ".join("A%d%s at strain %s" %(k+1, "+" if e > 0 else "-", abs(e))
+                                                                          for k, e in self.missing))
+        if not self.identified.all():
+            text += "; not determined: %s" %", ".join(np.array(self.names)[~self.identified])
+        return text
+        
+        
         """
         This program is responsible for the post-processing of the second and third order elastic constants (SOEC, TOEC).
         The input of the constants must be made through a file (see readme or example for more information)
@@ -316,7 +1783,8 @@ class Constants:
         
 
 class PostProcess():
-    def __init__(self,constants, output, pressure, iteration, steps):    
+    def __init__(self,constants, output, pressure, iteration, steps, plotres=None, plots=("3d",), planes=(), sectionres=360, mesh=(),
+                 cmap="jet", title="", artifact="", formats=(), covariance=None):    
         """
         This class is responsible for the post-processing of the second and third order elastic constants (SOEC, TOEC).
         The input arguments are:  Constants, Output folder, Pressure change, number of iteration steps, number of integration steps.
@@ -331,6 +1799,16 @@ class PostProcess():
         If only numerical results are needed it can be set to 1 which will greatly decrease the computing time.
         The number of integration steps is for calculating the pressure derivatives. The effect on computing time is small.
         For normal pressure changes like 1,10 GPa the effect of n. of iteration steps is also small. However a 1000 is used as a standart value.   
+        The plot resolution is the number of points in theta and phi that are actually drawn. It is independent of the number of iteration steps,
+        which is kept for the numerical results. If not given, half of the iteration steps is used (same look as the former rstride=2 plots).
+        The plots are a list of the graphs to produce: "3d" surfaces, "stereo" and "equalarea" maps of the standard triangle or "none".
+        The planes are Miller indices (e.g. "001", "1-10") of planes in which the cross sections are calculated at sectionres angles.
+        The mesh is a list of formats ("ply", "vtk", "obj") to which the surface is exported at the full numeric resolution.
+        The cmap is the colour map of all graphs and the title is put in front of the graph titles.
+        The artifact ("npz" or "mmap") stores the computed arrays to Artifact.npz, from which the Replot class can redraw the graphs.
+        The formats are machine-readable outputs, of which "csv" is written here as Trajectory.csv (the summary and npz are written by Main).
+        The covariance (9x9) of the constants from the least square fit, when given, is propagated to all the results of store
+        and the standard errors are written to Uncertainties.txt (see the uncertainty method).
         
         The output are three graphs (Young moduli (E) at zero pressure, the difference in E for given applied pressure and the same graph normalized, all as a function of direction)
         Also a text file is created with numerical data (more details in store method).            
@@ -340,17 +1818,26 @@ class PostProcess():
         self.iteration = iteration
         self.steps = steps
         self.outpath = output  
-            
-        self.theta = np.linspace(0,2*math.pi, self.iteration) # Surface integral of theta from 0 to two pi 
-        self.phi = np.linspace(0,math.pi, self.iteration) # Surface integral of phi from 0 to pi. Together with theta covers all directions
-        self.data = np.zeros((self.iteration**2,3)) # here the data for plot will be stored
-        self.data2 = np.zeros((self.iteration**2,3)) # Every variable with 2 at the end is for the second set of data and carries out the same function as non integered variable. 
-        
-        #The loop below defines all necessary variables in the apropriate format
-        self.preparearrays = ("x1","y1","z1","r1","x2","y2","z2","r2","difx","dify","difz","difr","xnorm","ynorm","znorm","rnorm")
-        for name in self.preparearrays:
-            exec("self.%s = np.zeros((self.iteration,self.iteration))" %name)
-            
+        if plotres is None:
+            plotres = (self.iteration+1)//2
+        self.plotres = plotres
+        self.plots = list(plots)
+        for kind in self.plots:
+            if kind not in ("3d", "stereo", "equalarea", "none"):
+                raise ValueError("Unknown kind of plot '%s', use 3d, stereo, equalarea or none" %kind)
+        self.planes = list(planes)
+        self.sectionres = sectionres
+        self.mesh = list(mesh)
+        for kind in self.mesh:
+            if kind not in ("ply", "vtk", "obj"):
+                raise ValueError("Unknown mesh format '%s', use ply, vtk or obj" %kind)
+        self.cmap = cmap
+        self.title = title
+        if artifact not in ("", "npz", "mmap"):
+            raise ValueError("Unknown kind of artifact '%s', use npz or mmap" %artifact)
+        self.artifact = artifact
+        self.formats = list(formats)
+        self.covariance = covariance
              
         self.process()
         
@@ -368,6 +1855,7 @@ class PostProcess():
         d = Integration(self.input, float(self.pressure), self.steps)        
         self.c = np.zeros((self.steps,3)) # self.c is the array containing the SOEC as a function of pressure
         self.c = d.solve()
+        self.P = d.P
         
        
     def young(self):
@@ -429,114 +1917,61 @@ class PostProcess():
         self.ptoecR[1] = (A/(2*A+3)*(self.input[3]-self.input[5]+3/A*(self.input[6]+2*self.input[7])-4*self.ptoecR[2]))/3
         self.ptoecR[0] = (9*self.ptoecV[0]+18*self.ptoecV[1]+8*self.ptoecV[2]-18*self.ptoecR[1]-8*self.ptoecR[2])/9
         
-    def plotdata(self):
+    def directional(self, compliances, l, m, n):
+        """
+        Returns the Young moduli in the directions given by direction cosines l, m, n (arrays of the same shape).
+        The compliances are [S11, S12, S44] and 1/E = S11 - 2*(S11-S12-S44/2)*(l^2*m^2 + m^2*n^2 + n^2*l^2)
+        """
+        constant = 2*(compliances[0]-compliances[1]-0.5*compliances[2])
+        cosines = l**2*m**2 + m**2*n**2 + n**2*l**2
+        return 1/(compliances[0]-cosines*constant)
+        
+    def surface(self, resolution):
+        """
+        Evaluates the Young moduli on a resolution x resolution grid of directions,
+        theta from 0 to two pi (rows) and phi from 0 to pi (columns). Together they cover all directions.
+        Returns the direction cosines and the Young moduli at zero and user defined pressure.
+        """
+        self.theta = np.linspace(0,2*math.pi, resolution)
+        self.phi = np.linspace(0,math.pi, resolution)
+        theta, phi = np.meshgrid(self.theta, self.phi, indexing="ij")
+        l = np.cos(theta)*np.sin(phi)
+        m = np.sin(theta)*np.sin(phi)
+        n = np.cos(phi)
+        return l, m, n, self.directional(self.res[0], l, m, n), self.directional(self.res[-1], l, m, n)
+        
+    def plotdata(self, resolution=None):
         """
         This method creates an arrays of x,y,z coordinates for a dense set of directions in 3D.
         The data is returned in a format suitable for plotting with plot_surface which is
-        a 2D array of number of iteration in each dimension.
+        a 2D array of resolution points in each dimension (plot resolution by default).
         Three sets of data is prepared:
         Young moduli as a function of direction at zero pressure
         The difference in Young moduli as a function of direction between zero and user defined pressure. 
         The normalized difference in Young moduli as a function of direction between zero and user defined pressure.
             The difference is normalized by the value of Young at zero pressure in that direction
         """
-        self.compl = np.array([self.res[0], self.res[-1]]) # Take the needed values of compliances from previous results
-        
-        k=0 # Calculate the value of Young moduli for given theta and phi for both pressures.
-        # The k integer distinguish between values at zero pressure and user pressure (stored to data2)
-        for data in self.compl:
-            i=0
-            self.constant = 2*(data[0]-data[1]-0.5*data[2])
-            for theta in self.theta:
-                for phi in self.phi:
-                    cosA = math.sin(phi)*math.cos(theta)
-                    cosC = math.cos(phi)
-                    self.cosines = ((1-cosA**2)*(cosA**2+cosC**2)-cosC**4)
-                    Young = 1/(data[0]-(self.cosines*self.constant))
-                    if k==0:
-                        self.data[i] = [theta,phi,Young]
-                    if k==1:
-                        self.data2[i] = [theta, phi, Young]
-                    i+= 1
-            k=1
-            
-        # The r (radius) of the plot is the Young moduli    
-        i=0 
-        j=0 # Converts spherical coordinates to cartesian for the zero pressure
-        for value in self.data:
-           
-            self.x1[j,i] = float(value[2]*math.cos(value[0])*math.sin(value[1]))
-            self.y1[j,i] = float(value[2]*math.sin(value[0])*math.sin(value[1]))
-            self.z1[j,i] = float(value[2]*math.cos(value[1]))
-            self.r1[j,i] = float(value[2])
-            i+=1
-            if i==self.iteration:
-                i=0
-                j+=1
-                
-        i=0
-        j=0 # Converts spherical coordinates to cartesian for the user pressure
-        for value in self.data2:
-           
-            self.x2[j,i] = float(value[2]*math.cos(value[0])*math.sin(value[1]))
-            self.y2[j,i] = float(value[2]*math.sin(value[0])*math.sin(value[1]))
-            self.z2[j,i] = float(value[2]*math.cos(value[1]))
-            self.r2[j,i] = float(value[2])
-            i+=1
-            if i==self.iteration:
-                i=0
-                j+=1
-                
-        # Calculates the difference of Young moduli which is what we are interested in.        
-        self.difr = (self.r2-self.r1)
-                
-        # The difference is stored in a simple 1D list insted of a 2D array.
-        # This is so that each value can be easier to call with an increasing integer in next part of the code
-        difflist = list() 
-        for value in self.difr:
-            for another in value:
-                difflist.append(another)
-       
+        if resolution is None:
+            resolution = self.plotres
+        l, m, n, self.r1, self.r2 = self.surface(resolution)
+        # The r (radius) of the plot is the Young moduli
+        self.x1, self.y1, self.z1 = self.r1*l, self.r1*m, self.r1*n
+        self.x2, self.y2, self.z2 = self.r2*l, self.r2*m, self.r2*n
         
+        # Calculates the difference of Young moduli which is what we are interested in.
         # It is important to note, that x1-x2 doesn't work and deltax must be calculated from deltar
+        self.difr = (self.r2-self.r1)
+        self.difx, self.dify, self.difz = self.difr*l, self.difr*m, self.difr*n
         
-        i=0
-        j=0 
-        k=0 # Converts spherical coordinates to cartesian for the difference in Young moduli
-        for value in self.data:
-           
-            self.difx[j,i] = float(difflist[k]*math.cos(value[0])*math.sin(value[1]))
-            self.dify[j,i] = float(difflist[k]*math.sin(value[0])*math.sin(value[1]))
-            self.difz[j,i] = float(difflist[k]*math.cos(value[1]))
-            i+=1
-            k+=1
-            if i==self.iteration:
-                i=0
-                j+=1
-                
-              
         self.rnorm = np.divide(self.difr, self.r1)*100 # Change to percentages
-        # Again a list of normalized radii is created
-        normlist = list()
-        for value in self.rnorm:
-            for another in value:
-                normlist.append(another)                
-        i=0
-        j=0
-        k=0# Converts spherical coordinates to cartesian
-        for value in self.data:
-           
-            self.xnorm[j,i] = float(normlist[k]*math.cos(value[0])*math.sin(value[1]))
-            self.ynorm[j,i] = float(normlist[k]*math.sin(value[0])*math.sin(value[1]))
-            self.znorm[j,i] = float(normlist[k]*math.cos(value[1]))
-            self.rnorm[j,i] = float(normlist[k])
-            k+=1
-            i+=1
-            if i==self.iteration:
-                i=0
-                j+=1
-             
+        self.xnorm, self.ynorm, self.znorm = self.rnorm*l, self.rnorm*m, self.rnorm*n
 
+    def titled(self, text):
+        """Puts the user defined title in front of the title of a graph."""
+        if self.title:
+            return "%s: %s" %(self.title, text)
+        return text
+        
     def plot(self):  
         """
         This method takes the data prepared by plotdata method and plots it in 3D
@@ -553,15 +1988,15 @@ class PostProcess():
         # Prepares the colour scheme to show the value of r not z     
         minim, maxim = self.difr.min(), self.difr.max()
         norm = matplotlib.colors.Normalize(minim, maxim)
-        m = plt.cm.ScalarMappable(norm=norm, cmap='jet')     
+        m = plt.cm.ScalarMappable(norm=norm, cmap=self.cmap)     
         m.set_array(self.difr)
         fcolors = m.to_rgba(self.difr)
         
         fig = plt.figure()
         ax = fig.add_subplot(111, projection='3d')
-        ax.set_title("The difference in Young moduli") 
-        ax.plot_surface(self.difx, self.dify, self.difz, rstride=2, cstride=2,  facecolors=fcolors)
-        cb = fig.colorbar(m)
+        ax.set_title(self.titled("The difference in Young moduli"))
+        ax.plot_surface(self.difx, self.dify, self.difz, rstride=1, cstride=1,  facecolors=fcolors)
+        cb = fig.colorbar(m, ax=ax)
         cb.ax.set_ylabel('Young moduli in GPa', rotation=270, labelpad=25)
         ax.set_xlabel('[100]')
         ax.set_ylabel('[010]')
@@ -574,15 +2009,15 @@ class PostProcess():
         # Young moduli for zero pressure 
         minim, maxim = self.r1.min(), self.r1.max()
         norm = matplotlib.colors.Normalize(minim, maxim)
-        n = plt.cm.ScalarMappable(norm=norm, cmap='jet')     
+        n = plt.cm.ScalarMappable(norm=norm, cmap=self.cmap)     
         n.set_array(self.r1)
         fcolors = n.to_rgba(self.r1)
         
         fig = plt.figure()
         ax = fig.add_subplot(111, projection='3d')
-        ax.set_title("The Young moduli at zero pressure") 
-        ax.plot_surface(self.x1, self.y1, self.z1, rstride=2, cstride=2,  facecolors=fcolors)
-        cb = fig.colorbar(n)
+        ax.set_title(self.titled("The Young moduli at zero pressure"))
+        ax.plot_surface(self.x1, self.y1, self.z1, rstride=1, cstride=1,  facecolors=fcolors)
+        cb = fig.colorbar(n, ax=ax)
         cb.ax.set_ylabel('Young moduli in GPa', rotation=270, labelpad=25)
         ax.set_xlabel('[100]')
         ax.set_ylabel('[010]')
@@ -593,15 +2028,15 @@ class PostProcess():
         # Normalized difference in young moduli
         minim, maxim = self.rnorm.min(), self.rnorm.max()
         norm = matplotlib.colors.Normalize(minim, maxim)
-        o = plt.cm.ScalarMappable(norm=norm, cmap='jet')     
+        o = plt.cm.ScalarMappable(norm=norm, cmap=self.cmap)     
         o.set_array(self.rnorm)
         fcolors = o.to_rgba(self.rnorm)
         
         fig = plt.figure()
         ax = fig.add_subplot(111, projection='3d')
-        ax.set_title("The normalised difference in young moduli") 
-        ax.plot_surface(self.xnorm, self.ynorm, self.znorm, rstride=2, cstride=2,  facecolors=fcolors)
-        cb = fig.colorbar(o)
+        ax.set_title(self.titled("The normalised difference in young moduli"))
+        ax.plot_surface(self.xnorm, self.ynorm, self.znorm, rstride=1, cstride=1,  facecolors=fcolors)
+        cb = fig.colorbar(o, ax=ax)
         cb.ax.set_ylabel('Percentage change in Young moduli', rotation=270, labelpad=25)
         ax.set_xlabel('[100]')
         ax.set_ylabel('[010]')
@@ -610,6 +2045,205 @@ class PostProcess():
         plt.savefig(graphname)
        
                
+    def project(self, l, m, n, kind):
+        """
+        Projects the directions l, m, n of the upper hemisphere to the plane.
+        kind is "stereo" for the stereographic or "equalarea" for the Lambert equal-area projection.
+        """
+        if kind == "stereo":
+            scale = 1/(1+n)
+        else:
+            scale = np.sqrt(2/(1+n))
+        return l*scale, m*scale
+        
+    def unproject(self, X, Y, kind):
+        """Inverse of the project method. Returns the direction cosines l, m, n for the points X, Y of the projection plane."""
+        r2 = X**2+Y**2
+        if kind == "stereo":
+            return 2*X/(1+r2), 2*Y/(1+r2), (1-r2)/(1+r2)
+        k = np.sqrt(np.clip(1-r2/4, 0, None))
+        return k*X, k*Y, 1-r2/2
+        
+    def triangle(self, points=100):
+        """
+        Returns the edges of the standard triangle [001]-[101]-[111] as direction cosines.
+        The edges are great circles, so they are obtained by normalizing linear interpolations between the corners.
+        """
+        corners = np.array([[0., 0., 1.], [1., 0., 1.], [1., 1., 1.], [0., 0., 1.]])
+        t = np.linspace(0, 1, points)[:, None]
+        edges = np.concatenate([(1-t)*corners[i]+t*corners[i+1] for i in range(3)])
+        edges /= np.linalg.norm(edges, axis=1)[:, None]
+        return edges[:, 0], edges[:, 1], edges[:, 2]
+        
+    def mapdata(self, kind, resolution=None):
+        """
+        This method prepares the 2D maps of the standard triangle 0 <= m <= l <= n, which holds all the directions
+        that are distinct in a cubic crystal. A regular grid of resolution points across the projected triangle is
+        mapped back to directions, so every pixel is evaluated once. Pixels outside the triangle are masked.
+        The three maps are the same as for the 3D plots: E at zero pressure, the difference in E and the normalized difference.
+        """
+        if resolution is None:
+            resolution = self.plotres
+        X, Y = self.project(*self.triangle(), kind)
+        self.extent = [X.min(), X.max(), Y.min(), Y.max()]
+        height = max(2, int(math.ceil(resolution*(self.extent[3]-self.extent[2])/(self.extent[1]-self.extent[0]))))
+        X, Y = np.meshgrid(np.linspace(self.extent[0], self.extent[1], resolution), np.linspace(self.extent[2], self.extent[3], height))
+        l, m, n = self.unproject(X, Y, kind)
+        outside = (m < -1e-9) | (l < m-1e-9) | (n < l-1e-9)
+        E1 = self.directional(self.res[0], l, m, n)
+        E2 = self.directional(self.res[-1], l, m, n)
+        self.maps = [np.ma.masked_where(outside, E1), np.ma.masked_where(outside, E2-E1), np.ma.masked_where(outside, (E2-E1)/E1*100)]
+        
+    def plotmap(self, kind):
+        """
+        This method plots the maps from the mapdata method with imshow side by side into one graph,
+        which is much faster than the 3D surfaces and easy to compare between materials.
+        """
+        self.mapdata(kind)
+        titles = ("Young moduli at zero pressure", "The difference in Young moduli", "The normalised difference")
+        labels = ("Young moduli in GPa", "Young moduli in GPa", "Percentage change in Young moduli")
+        edges = self.project(*self.triangle(), kind)
+        corners = self.project(np.array([0., 1., 1.])/np.array([1., math.sqrt(2), math.sqrt(3)]),
+                               np.array([0., 0., 1.])/np.array([1., math.sqrt(2), math.sqrt(3)]),
+                               np.array([1., 1., 1.])/np.array([1., math.sqrt(2), math.sqrt(3)]), kind)
+        
+        fig, axes = plt.subplots(1, 3, figsize=(15, 4.5))
+        for ax, data, title, label in zip(axes, self.maps, titles, labels):
+            image = ax.imshow(data, origin="lower", extent=self.extent, cmap=self.cmap, interpolation="nearest")
+            ax.plot(edges[0], edges[1], color="black", linewidth=1)
+            for x, y, name in zip(corners[0], corners[1], ("[001]", "[101]", "[111]")):
+                ax.annotate(name, (x, y), textcoords="offset points", xytext=(0, 6), ha="center")
+            ax.set_title(self.titled(title), pad=20)
+            ax.set_axis_off()
+            cb = fig.colorbar(image, ax=ax, shrink=0.8)
+            cb.ax.set_ylabel(label, rotation=270, labelpad=15)
+        
+        names = {"stereo": "Stereographic projection.png", "equalarea": "Equal-area projection.png"}
+        graphname = os.path.join(self.outpath, names[kind])
+        plt.savefig(graphname)
+        plt.close(fig)
+               
+    def sectiondata(self, planes, resolution):
+        """
+        Evaluates the Young moduli along the great circles of the given planes (list of Miller indices as strings).
+        For each plane an in-plane basis u, v is chosen, u being the projection of the cubic axis closest to the plane,
+        and the directions are cos(angle)*u + sin(angle)*v. All planes and angles are evaluated in one pass,
+        so the cost is linear in the angular resolution.
+        Returns the angles and arrays (number of planes, resolution) of E at zero and user pressure.
+        """
+        normals = np.array([[int(index) for index in re.findall(r"-?\d", plane)] for plane in planes], dtype=float)
+        if normals.ndim != 2 or normals.shape[1] != 3 or not np.all(np.any(normals != 0, axis=1)):
+            raise ValueError("Planes must be given by three Miller indices, e.g. 001,110,1-11, got %s" %",".join(planes))
+        normals /= np.linalg.norm(normals, axis=1)[:, None]
+        axes = np.eye(3)[np.argmin(abs(normals), axis=1)]
+        u = axes - np.sum(axes*normals, axis=1)[:, None]*normals
+        u /= np.linalg.norm(u, axis=1)[:, None]
+        v = np.cross(normals, u)
+        
+        angles = np.linspace(0, 2*math.pi, resolution)
+        directions = np.cos(angles)[None, :, None]*u[:, None, :] + np.sin(angles)[None, :, None]*v[:, None, :]
+        l, m, n = directions[..., 0], directions[..., 1], directions[..., 2]
+        return angles, self.directional(self.res[0], l, m, n), self.directional(self.res[-1], l, m, n)
+        
+    def crosssection(self):
+        """
+        This method calculates the cross sections for the user defined planes.
+        A polar graph of E at zero and user defined pressure and of the normalized difference is made for each plane.
+        All the curves are stored in "Cross sections.csv": the angle in degrees and then E, the difference in E
+        and the normalized difference in percent for every plane.
+        """
+        angles, E1, E2 = self.sectiondata(self.planes, self.sectionres)
+        difference = E2-E1
+        normalized = difference/E1*100
+        
+        columns = [np.degrees(angles)]
+        header = ["angle in degrees"]
+        for i, plane in enumerate(self.planes):
+            columns.extend([E1[i], difference[i], normalized[i]])
+            header.extend(["E(%s) in GPa" %plane, "difference in E(%s) in GPa" %plane, "normalized difference in E(%s) in %%" %plane])
+        np.savetxt(os.path.join(self.outpath, "Cross sections.csv"), np.column_stack(columns), delimiter=",", header=",".join(header))
+        
+        fig, axes = plt.subplots(2, len(self.planes), subplot_kw={"projection": "polar"}, figsize=(4*len(self.planes), 8), squeeze=False)
+        for i, plane in enumerate(self.planes):
+            axes[0, i].plot(angles, E1[i], label="zero pressure")
+            axes[0, i].plot(angles, E2[i], label="%s GPa" %self.pressure)
+            axes[0, i].set_title(self.titled("Young moduli in (%s) in GPa" %plane), pad=15)
+            axes[1, i].plot(angles, normalized[i], color="C2")
+            axes[1, i].set_title(self.titled("Percentage change in (%s)" %plane), pad=15)
+        axes[0, 0].legend(loc="lower left", bbox_to_anchor=(-0.1, -0.15))
+        fig.tight_layout()
+        plt.savefig(os.path.join(self.outpath, "Cross sections.png"))
+        plt.close(fig)
+               
+    def surfacerows(self, resolution):
+        """
+        Yields the surface of the surface method one row (one value of theta) at a time, so that large meshes can be
+        written without holding the whole grid in memory. Each row holds the direction cosines and E at zero and user pressure.
+        """
+        phi = np.linspace(0,math.pi, resolution)
+        for theta in np.linspace(0,2*math.pi, resolution):
+            l = math.cos(theta)*np.sin(phi)
+            m = math.sin(theta)*np.sin(phi)
+            n = np.cos(phi)
+            yield l, m, n, self.directional(self.res[0], l, m, n), self.directional(self.res[-1], l, m, n)
+            
+    def meshfaces(self, row, resolution):
+        """Returns the vertex indices of the quads between the surface rows row and row+1, as an array (resolution-1, 4)."""
+        first = row*resolution + np.arange(resolution-1)
+        return np.column_stack([first, first+1, first+resolution+1, first+resolution])
+        
+    def exportmesh(self, kind, resolution=None):
+        """
+        This method writes the surface of Young moduli at zero pressure (radius is E) as a mesh that can be opened in e.g. ParaView.
+        The binary PLY and VTK polydata files carry the scalar fields E, difference in E and normalized difference in E,
+        OBJ only carries the geometry. The mesh is streamed row by row straight from the vectorized evaluation,
+        so the memory use does not grow with the number of vertices.
+        """
+        if resolution is None:
+            resolution = self.iteration
+        vertices = resolution**2
+        faces = (resolution-1)**2
+        names = {"ply": "Young moduli.ply", "vtk": "Young moduli.vtk", "obj": "Young moduli.obj"}
+        f = open(os.path.join(self.outpath, names[kind]), 'wb')
+        
+        if kind == "ply":
+            f.write(("ply\nformat binary_little_endian 1.0\ncomment TrelaCalc Young moduli, the radius is E at zero pressure\n"
+                     "element vertex %d\nproperty float x\nproperty float y\nproperty float z\n"
+                     "property float E\nproperty float dE\nproperty float dEnorm\n"
+                     "element face %d\nproperty list uchar int vertex_indices\nend_header\n" %(vertices, faces)).encode("ascii"))
+            for l, m, n, E1, E2 in self.surfacerows(resolution):
+                f.write(np.column_stack([E1*l, E1*m, E1*n, E1, E2-E1, (E2-E1)/E1*100]).astype('<f4').tobytes())
+            face = np.zeros(resolution-1, dtype=[("count", 'u1'), ("indices", '<i4', 4)])
+            face["count"] = 4
+            for row in range(resolution-1):
+                face["indices"] = self.meshfaces(row, resolution)
+                f.write(face.tobytes())
+                
+        elif kind == "vtk":
+            f.write(("# vtk DataFile Version 3.0\nTrelaCalc Young moduli, the radius is E at zero pressure\nBINARY\n"
+                     "DATASET POLYDATA\nPOINTS %d float\n" %vertices).encode("ascii"))
+            for l, m, n, E1, E2 in self.surfacerows(resolution):
+                f.write(np.column_stack([E1*l, E1*m, E1*n]).astype('>f4').tobytes())
+            f.write(("\nPOLYGONS %d %d\n" %(faces, 5*faces)).encode("ascii"))
+            for row in range(resolution-1):
+                f.write(np.column_stack([np.full(resolution-1, 4), self.meshfaces(row, resolution)]).astype('>i4').tobytes())
+            f.write(("\nPOINT_DATA %d\n" %vertices).encode("ascii"))
+            # VTK stores every field as a separate block, the rows are cheap so they are evaluated again for each field
+            fields = (("E", lambda E1, E2: E1), ("dE", lambda E1, E2: E2-E1), ("dEnorm", lambda E1, E2: (E2-E1)/E1*100))
+            for name, field in fields:
+                f.write(("SCALARS %s float 1\nLOOKUP_TABLE default\n" %name).encode("ascii"))
+                for l, m, n, E1, E2 in self.surfacerows(resolution):
+                    f.write(field(E1, E2).astype('>f4').tobytes())
+                f.write(b"\n")
+                
+        else:
+            f.write(b"# TrelaCalc Young moduli, the radius is E at zero pressure\n")
+            for l, m, n, E1, E2 in self.surfacerows(resolution):
+                np.savetxt(f, np.column_stack([E1*l, E1*m, E1*n]), fmt="v %.7g %.7g %.7g")
+            for row in range(resolution-1):
+                np.savetxt(f, self.meshfaces(row, resolution)+1, fmt="f %d %d %d %d")
+        f.close()
+               
     def store(self):
         """This method stores data into user-specified file. The stored data is:
         Elastic compliances [S11, S12, S44] for no and the user defined pressure ( S in units of inverse GPa).
@@ -619,15 +2253,15 @@ class PostProcess():
         Polycrystalline shear for zero and user definied pressure, calculated using both Voigt and Reuss method. (shear in GPa)
         Polycrystalline TOECs calculated for zero pressure using Voigt and Reuss method (in GPa)"""
         
-        values = np.array([self.res[0],self.res[-1], self.E[0], self.E[-1], self.c[0], self.c[-1],np.array(self.anisotropy[0]), np.array(self.anisotropy[-1]), self.shearV, self.shearR, self.ptoecV, self.ptoecR ])
-        texts = np.array([" # These are the elastic compliances with no pressure applied [S11, S12, S44]", " # These are the elastic compliances with %s GPa pressure applied [S11, S12, S44]\n" %self.pressure,\
+        values = [self.res[0],self.res[-1], self.E[0], self.E[-1], self.c[0], self.c[-1],np.array(self.anisotropy[0]), np.array(self.anisotropy[-1]), self.shearV, self.shearR, self.ptoecV, self.ptoecR ]
+        texts = [" # These are the elastic compliances with no pressure applied [S11, S12, S44]", " # These are the elastic compliances with %s GPa pressure applied [S11, S12, S44]\n" %self.pressure,\
             " # These are the directional Young's moduli with no pressure applied [E100, E110, E111]"," # These are the directional Young's moduli with %s GPA pressure applied [E100, E110, E111]\n" %self.pressure,\
             " # These are the SOEC with no pressure applied [C11, C12, C44]"," # These are the SOEC with %s GPA pressure applied [C11, C12, C44]\n" %self.pressure,\
             " # The anisotropy at zero pressure.", " # The anisotropy at %s GPa pressure.\n"%self.pressure,\
             " # These are the values of polycrystalline shear obtained through Voigt approach in GPa for zero and %s pressure" %self.pressure,\
             " # These are the values of polycrystalline shear obtained through Reuss approach in GPa for zero and %s pressure\n" %self.pressure,\
             " # These are the polycrystalline TOECS calculated using Voigt method at zero pressure, in the following order: C123, C144, C456",\
-            " # These are the polycrystalline TOECS calculated using Reuss method at zero pressure, in the following order: C123, C144, C456\n"])
+            " # These are the polycrystalline TOECS calculated using Reuss method at zero pressure, in the following order: C123, C144, C456\n"]
         
         self.completeoutput = os.path.join(self.outpath, "Additional Data.txt")
         f = open(self.completeoutput, 'w')
@@ -637,7 +2271,115 @@ class PostProcess():
             f.write(str(texts[i]))
             f.write("\n")
             i+=1
-            
+        f.close()
+        
+    # Names of the values returned by the properties method, (0) at zero and (P) at the user defined pressure
+    derived = tuple("%s(%s)" %(name, state) for state in ("0", "P") for name in ("S11", "S12", "S44", "E100", "E110", "E111", "anisotropy")) \
+        + ("C11(P)", "C12(P)", "C44(P)", "shearV(0)", "shearV(P)", "shearR(0)", "shearR(P)",
+           "C123V", "C144V", "C456V", "C123R", "C144R", "C456R")
+        
+    def properties(self, x, c):
+        """
+        Returns the results of the young and polycrystal methods at zero and user pressure as one array (names in derived),
+        for the constants x and the SOEC c at the user pressure. The formulas are the same, written so that they also take
+        complex numbers, which gives their exact derivatives by the complex step in the uncertainty method.
+        """
+        values = []
+        for c11, c12, c44 in (x[:3], c):
+            denominator = c11**2+c11*c12-2*c12**2
+            s11, s12, s44 = (c11+c12)/denominator, -c12/denominator, 1/c44
+            var = s11-s12-0.5*s44
+            values.append([s11, s12, s44, 1/s11, 1/(s11-0.5*var), 1/(s11-2*var/3), 2*c44/(c11-c12)])
+        shear = [(c11-c12+3*c44)/5 for c11, c12, c44 in (x[:3], c)] + [5/(4*(state[0]-state[1])+3*state[2]) for state in values]
+        A = values[0][6]
+        V = [(x[3]+18*x[4]+16*x[5]-30*x[6]-12*x[7]+16*x[8])/35, (x[3]+4*x[4]-5*x[5]+19*x[6]+2*x[7]-12*x[8])/35,
+             (x[3]-3*x[4]+2*x[5]-9*x[6]+9*x[7]+9*x[8])/35]
+        R456 = (((5*A/(2*A+3))**3)/35)*(x[3]-3*x[4]+2*x[5]-(9/(A**2)*(x[6]-x[7]))+(9/(A**3)*x[8]))
+        R144 = (A/(2*A+3)*(x[3]-x[5]+3/A*(x[6]+2*x[7])-4*R456))/3
+        R123 = (9*V[0]+18*V[1]+8*V[2]-18*R144-8*R456)/9
+        return np.array(values[0]+values[1]+list(c)+[shear[0], shear[1], shear[2], shear[3]]+V+[R123, R144, R456])
+        
+    def uncertainty(self):
+        """
+        This method propagates the covariance C of the constants to the results (first order, through the Jacobian J: J C J^T).
+        The results depend on the constants x directly and through the SOEC at the user pressure c(P), whose derivatives
+        S = dc(P)/dx come from the sensitivity equations of the integration. The derivatives of the formulas are taken by the
+        complex step, Im f(u + ih e_k)/h, which is exact to rounding: J = df/dx + df/dc S.
+        The values and standard errors of the constants and all the derived results are written to Uncertainties.txt.
+        """
+        S = Integration(self.input, float(self.pressure), self.steps).sensitivity()[-1]
+        u = np.concatenate([self.input, self.c[-1]]).astype(complex)
+        h = 1e-30
+        J = np.column_stack([self.properties(*np.split(u+1j*h*np.eye(12)[k], [9])).imag/h for k in range(12)])
+        J = J[:, :9] + J[:, 9:] @ S
+        self.values = self.properties(np.array(self.input, dtype=float), self.c[-1])
+        self.errors = np.sqrt(np.diag(J @ self.covariance @ J.T))
+        self.constanterrors = np.sqrt(np.diag(self.covariance))
+        
+        lines = ["# Standard errors propagated from the covariance of the least square fit, (P) at %s GPa" %self.pressure,
+                 "# name, value, standard error (GPa, compliances in 1/GPa)"]
+        lines.extend("%s %.17g %.6g" %item for item in zip(Constants.names, self.input, self.constanterrors))
+        lines.extend("%s %.17g %.6g" %item for item in zip(self.derived, self.values, self.errors))
+        f = open(os.path.join(self.outpath, "Uncertainties.txt"), 'w')
+        f.write("\n".join(lines)+"\n")
+        f.close()
+        
+    def storecsv(self):
+        """Stores the SOEC, compliances, Young moduli and anisotropy at every integration step as one csv table in full precision."""
+        header = "pressure,C11,C12,C44,S11,S12,S44,E100,E110,E111,anisotropy"
+        np.savetxt(os.path.join(self.outpath, "Trajectory.csv"), np.column_stack([self.P, self.c, self.res, self.E, self.anisotropy]),
+                   fmt="%.17g", delimiter=",", header=header, comments="")
+        
+    def summary(self):
+        """Returns the values stored in Additional Data.txt as a dictionary for Summary.json."""
+        names = dict(S=("S11", "S12", "S44"), E=("E100", "E110", "E111"), C=("C11", "C12", "C44"), P=("C123", "C144", "C456"))
+        state = lambda i: dict(compliances=dict(zip(names["S"], self.res[i].tolist())), young=dict(zip(names["E"], self.E[i].tolist())),
+                               soec=dict(zip(names["C"], self.c[i].tolist())), anisotropy=float(self.anisotropy[i]))
+        summary = dict(zeropressure=state(0), userpressure=state(-1),
+                       shear=dict(voigt=self.shearV.tolist(), reuss=self.shearR.tolist()),
+                       polycrystaltoec=dict(voigt=dict(zip(names["P"], self.ptoecV.tolist())), reuss=dict(zip(names["P"], self.ptoecR.tolist()))))
+        if hasattr(self, "errors"):
+            summary["standarderrors"] = dict(zip(Constants.names+self.derived, self.constanterrors.tolist()+self.errors.tolist()))
+        return summary
+        
+    def arrays(self):
+        """Returns the pressure trajectory and polycrystal results as arrays for Results.npz."""
+        arrays = dict(P=self.P, c=self.c, res=self.res, E=self.E, anisotropy=self.anisotropy,
+                      shearV=self.shearV, shearR=self.shearR, ptoecV=self.ptoecV, ptoecR=self.ptoecR)
+        if hasattr(self, "errors"):
+            arrays.update(covariance=self.covariance, derivederrors=self.errors)
+        return arrays
+                    
+    def saveartifact(self):
+        """
+        This method stores everything computed by this class into Artifact.npz in the output folder:
+        the constants, the pressure trajectory of SOEC, compliances, Young moduli and anisotropy, the polycrystal results
+        and the surface of Young moduli at zero and user pressure at the full numeric resolution.
+        With "npz" the archive is compressed, with "mmap" it is not, so that Replot can memory-map the large surface grids.
+        """
+        l, m, n, E1, E2 = self.surface(self.iteration)
+        arrays = dict(constants=np.array(self.input), pressure=np.array(float(self.pressure)), iteration=np.array(self.iteration),
+                      steps=np.array(self.steps), c=self.c, res=self.res, E=self.E, anisotropy=self.anisotropy,
+                      shearV=self.shearV, shearR=self.shearR, ptoecV=self.ptoecV, ptoecR=self.ptoecR,
+                      theta=self.theta, phi=self.phi, surface1=E1, surface2=E2)
+        path = os.path.join(self.outpath, "Artifact.npz")
+        if self.artifact == "npz":
+            np.savez_compressed(path, **arrays)
+        else:
+            np.savez(path, **arrays)
+                    
+    def render(self):
+        """This method produces all the graphs and mesh exports that were asked for."""
+        if "3d" in self.plots:
+            self.plotdata(self.plotres)
+            self.plot()
+        for kind in ("stereo", "equalarea"):
+            if kind in self.plots:
+                self.plotmap(kind)
+        if self.planes:
+            self.crosssection()
+        for kind in self.mesh:
+            self.exportmesh(kind)
                     
     def process(self):
         """This method is responsible for calling the necessary methods in the correct order."""
@@ -645,10 +2387,148 @@ class PostProcess():
         self.young()
         self.polycrystal()
         self.store()
-        self.plotdata()
-        self.plot()
+        if self.covariance is not None and np.isfinite(self.covariance).all():
+            self.uncertainty()
+        if "csv" in self.formats:
+            self.storecsv()
+        if self.artifact:
+            self.saveartifact()
+        self.render()
+        
+
+class Replot(PostProcess):
+    """
+    This class redraws the graphs of PostProcess from an Artifact.npz saved by a previous run, without recomputing anything.
+    Members stored uncompressed (artifact=mmap) are memory-mapped, so only the rows of the surface that are plotted are read from disk.
+    """
+    def __init__(self, output, plotres=None, plots=("3d",), planes=(), sectionres=360, mesh=(), cmap="jet", title=""):
+        self.outpath = output
+        self.arrays = self.load(os.path.join(output, "Artifact.npz"))
+        self.input = list(self.arrays["constants"])
+        self.pressure = float(self.arrays["pressure"])
+        self.iteration = int(self.arrays["iteration"])
+        self.steps = int(self.arrays["steps"])
+        for name in ("c", "res", "E", "anisotropy", "shearV", "shearR", "ptoecV", "ptoecR"):
+            setattr(self, name, self.arrays[name])
+        PostProcess.__init__(self, self.input, output, self.pressure, self.iteration, self.steps, plotres, plots, planes, sectionres, mesh, cmap, title)
+        
+    def load(self, path):
+        """
+        Reads all arrays of an .npz archive into a dictionary. Uncompressed members are memory-mapped directly from the archive,
+        compressed members are read into memory.
+        """
+        arrays = {}
+        archive = zipfile.ZipFile(path)
+        f = open(path, 'rb')
+        for info in archive.infolist():
+            name = info.filename[:-len(".npy")]
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.lib.format.read_array(archive.open(info))
+                continue
+            # The data of a stored member starts after its local header, which has 30 bytes plus the name and the extra field
+            f.seek(info.header_offset+26)
+            namelength, extralength = struct.unpack("<HH", f.read(4))
+            f.seek(info.header_offset+30+namelength+extralength)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+            if len(shape) == 0 or 0 in shape:
+                arrays[name] = np.lib.format.read_array(archive.open(info))
+            else:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape, order='F' if fortran else 'C')
+        f.close()
+        archive.close()
+        return arrays
+        
+    def process(self):
+        """Only the graphs are produced, everything else is in the artifact."""
+        self.render()
+        
+    def surface(self, resolution):
+        """
+        Picks resolution rows and columns (including the first and last one) of the stored surface instead of evaluating it.
+        The grid cannot be refined beyond the numeric resolution of the run that saved the artifact.
+        """
+        rows = np.unique(np.linspace(0, self.iteration-1, min(resolution, self.iteration)).round().astype(int))
+        self.theta = np.asarray(self.arrays["theta"])[rows]
+        self.phi = np.asarray(self.arrays["phi"])[rows]
+        theta, phi = np.meshgrid(self.theta, self.phi, indexing="ij")
+        l = np.cos(theta)*np.sin(phi)
+        m = np.sin(theta)*np.sin(phi)
+        n = np.cos(phi)
+        return l, m, n, self.arrays["surface1"][rows][:, rows], self.arrays["surface2"][rows][:, rows]
         
 
+class Batch(PostProcess):
+    """
+    This class post-processes many sets of constants at once, e.g. the leave-one-out sets of Calculate. The integration over pressure
+    and the results of the young and polycrystal methods (the properties method, names in derived) are evaluated for all the sets
+    together as arrays, instead of a PostProcess run for each set. The integration takes fourth order Runge-Kutta steps on the
+    pressure grid of Integration for all the sets at once; with the usual 1000 steps it is exact to about 1e-12 GPa,
+    well within the tolerance of odeint used by Integration (about 1e-6 GPa).
+    The constants are an array (sets, 9), the results are in c (SOEC at the user pressure, (sets, 3)) and values (sets, len(derived)).
+    """
+    def __init__(self, constants, pressure, steps):
+        self.x = np.atleast_2d(np.asarray(constants, dtype=float))
+        self.pressure = pressure
+        self.steps = int(steps)
+        self.P = np.linspace(0, float(pressure), self.steps)
+        self.process()
+        
+    def f(self, y):
+        """
+        The right side of Integration.f for all the sets, y is (sets, 3). Every numerator is linear in the SOEC,
+        so it is the part of the TOEC (fixed, in K) plus one product y M.
+        """
+        return -(self.K + y @ self.M)/(y @ self.D)[:, None]
+        
+    def integrate(self):
+        """Returns the SOEC of all the sets at the user pressure. Only the current step is kept, so the memory does not grow with steps."""
+        x = self.x
+        self.K = np.column_stack([2*x[:, 4]+x[:, 3], x[:, 5]+2*x[:, 4], 2*x[:, 7]+x[:, 6]])
+        self.M = np.array([[2., -1., 1.], [2., -1., 2.], [0., 0., 1.]])
+        self.D = np.array([1., 2., 0.])
+        y = self.x[:, :3].copy()
+        for h in np.diff(self.P):
+            k1 = self.f(y)
+            k2 = self.f(y+h/2*k1)
+            k3 = self.f(y+h/2*k2)
+            k4 = self.f(y+h*k3)
+            y = y+h/6*(k1+2*k2+2*k3+k4)
+        return y
+        
+    def process(self):
+        self.c = self.integrate()
+        self.values = self.properties(self.x.T, self.c.T).T
+        
+    def jackknife(self):
+        """
+        Takes the first set as the one from all the data and the others as the leave-one-out sets theta_i (n of them) and returns
+        the jackknife bias (n-1)(mean theta_i - theta) and standard error sqrt((n-1)/n sum (theta_i - mean theta_i)^2)
+        of the constants and of all the derived results.
+        """
+        values = np.hstack([self.x, self.values])
+        full, sets = values[0], values[1:]
+        n = len(sets)
+        mean = sets.mean(axis=0)
+        self.full = full
+        self.bias = (n-1)*(mean-full)
+        self.error = np.sqrt((n-1)/n*np.sum((sets-mean)**2, axis=0))
+        return self.bias, self.error
+        
+    def store(self, filename):
+        """Writes the results of the jackknife method to the file."""
+        lines = ["# Jackknife over the %d leave-one-out sets of constants, (P) at %s GPa" %(len(self.x)-1, self.pressure),
+                 "# name, value from all data, jackknife bias, jackknife standard error, bias corrected value"]
+        lines.extend("%s %.17g %.6g %.6g %.10g" %(name, value, bias, error, value-bias)
+                     for name, value, bias, error in zip(Constants.names+self.derived, self.full, self.bias, self.error))
+        f = open(filename, 'w')
+        f.write("\n".join(lines)+"\n")
+        f.close()
+
+
 class Integration:
     """
     This class calculates the pressure derivatives of SOEC by small step integration. 
@@ -676,5 +2556,36 @@ class Integration:
         self.solution = odeint(self.f,self.y0, self.P)
 
         return self.solution
+        
+    def jacobians(self, y):
+        """
+        Returns the derivatives of f (dc/dP) with respect to the SOEC y (3x3) and to the nine constants x (3x9).
+        Every component of f is -N/D with D = c11+2*c12, so df = -dN/D + N*dD/D^2.
+        """
+        c11, c12, c44 = y
+        D = 2*c12+c11
+        N = np.array([2*self.x[4]+self.x[3]+2*c12+2*c11, self.x[5]+2*self.x[4]-c12-c11, 2*self.x[7]+self.x[6]+c44+2*c12+c11])
+        dNdy = np.array([[2., 2., 0.], [-1., -1., 0.], [1., 2., 1.]])
+        dNdx = np.zeros((3, 9))
+        dNdx[0, 3], dNdx[0, 4] = 1, 2
+        dNdx[1, 4], dNdx[1, 5] = 2, 1
+        dNdx[2, 6], dNdx[2, 7] = 1, 2
+        return -dNdy/D + np.outer(N, [1., 2., 0.])/D**2, -dNdx/D
+        
+    def g(self, z, P):
+        """The SOEC and their sensitivities S = dc/dx (3x9) together, dS/dP = df/dy S + df/dx."""
+        y, S = z[:3], z[3:].reshape(3, 9)
+        dfdy, dfdx = self.jacobians(y)
+        return np.concatenate([self.f(y, P), (dfdy @ S + dfdx).ravel()])
+        
+    def sensitivity(self):
+        """
+        Integrates the sensitivities of the SOEC to the nine constants along with the SOEC (forward sensitivity equations).
+        At zero pressure the SOEC are the first three constants, so S starts as [I 0]. Returns S at every pressure, shape (steps, 3, 9).
+        """
+        S0 = np.hstack([np.eye(3), np.zeros((3, 6))])
+        solution = odeint(self.g, np.concatenate([self.y0, S0.ravel()]), self.P)
+        return solution[:, 3:].reshape(-1, 3, 9)
 
-a=Main()
\ No newline at end of file
+if __name__ == "__main__":
+    a=Main()
\ No newline at end of file